@@ -2,30 +2,94 @@
 
 Usage:
     main.py
+    main.py serve [--host=<host> --port=<port> --jobs=<n> --queue=<n>
+                   --max_upload=<mb>]
     main.py <filename>
-    main.py --batch=input_dir [--recursive --output_dir=<output_dir>]
+    main.py --batch=input_dir [--recursive --output_dir=<output_dir>
+                               --timings --jobs=<n>
+                               --incremental --checksum
+                               --prefetch=<n> --reduce=<n> --store=<file>
+                               --database=<file> --report=<file>]
+    main.py --watch=input_dir [--recursive --jobs=<n> --interval=<seconds>
+                               --reduce=<n> --timings]
+    main.py --export=input_dir [--recursive --output_dir=<output_dir>
+                                --jobs=<n> --store=<file>]
 
 Options:
   -h --help             Show this screen.
   --version             Show version.
   --batch=<dir>         Input directory
+  --watch=<dir>         Segment images as they are added to a directory.
+  --interval=<seconds>  Time between polls of the watched directory
+                        [default: 2].
+  --host=<host>         Address the service listens on
+                        [default: 127.0.0.1].
+  --port=<port>         Port the service listens on [default: 8642].
+  --queue=<n>           Requests that may wait for a service worker
+                        before new ones are turned away [default: 8].
+  --max_upload=<mb>     Largest image upload the service accepts, in
+                        megabytes [default: 64].
   --recursive           Traverse directory structure recursively.
-  --output_dir=<dir>    Output directory of CSV file results. Defaults
-                        to the batch input directory.
+  --output_dir=<dir>    Output directory of CSV file results, or of
+                        crops with --export.  Defaults to the batch
+                        input directory.
+  --export=<dir>        Write a crop of every box found by a batch run
+                        over a directory.
+  --timings             Report the time spent in each segmentation stage.
+  --jobs=<n>            Number of images to segment in parallel
+                        [default: 1].
+  --incremental         Skip images segmented by an earlier run, unless
+                        they or the segmentation parameters changed.
+  --checksum            Detect changed images by content rather than by
+                        modification time.
+  --prefetch=<n>        Read up to n images ahead, and write results, in
+                        threads while segmenting.  Applies when --jobs is 1.
+  --reduce=<n>          Segment images decoded at 1/n of their size, with
+                        n of 2, 4 or 8, for faster, coarser boxes
+                        [default: 1].
+  --store=<file>        Write the boxes of all images to one .npz file
+                        rather than a CSV file per image.
+  --database=<file>     Also add the boxes of all images to an SQLite
+                        box database.
+  --report=<file>       Write the metrics of every image and a summary
+                        of the run to a JSON file.
 """
 from __future__ import print_function, division
 
-from PySide import QtGui
-
 import os
+import signal
 import sys
 import csv
+import threading
+import time
+import traceback
+from multiprocessing import Pool
+from Queue import Empty, Queue
 
-from .image_viewer import ImageViewer
 from .segment import segment_edges
+from .boxes import deduplicate
+from .cache import BufferPool
+from .timing import StageTimer
+from .manifest import Manifest, file_signature
+from .store import BoxStore
+from .database import BoxDatabase
+from .report import BatchReport, peak_rss, reset_peak_rss
 from . import docopt
 
-from skimage import io
+import cv2
+
+
+# Parameters of segment_edges in batch runs
+BATCH_PARAMETERS = {'threshold': 12, 'variance_threshold': 100,
+                    'size_filter': 1}
+
+# Name of the incremental run manifest in the batch input directory
+MANIFEST = '.inselect-manifest.jsonl'
+
+# Working arrays of segment_image, kept for the life of the process so
+# that images of the same shape reuse them; pools must not be shared
+# between threads, so each thread gets its own
+_buffers = threading.local()
 
 
 def is_image_file(file_name):
@@ -46,7 +110,19 @@ def save_rects(filename, rects):
             writer.writerow(rect)
 
 
+def read_rects(filename):
+    """Read the normalised boxes written by `save_rects`."""
+    with open(filename) as csvfile:
+        return [[float(v) for v in row]
+                for row in csv.reader(csvfile, delimiter=' ') if row]
+
+
 def launch_gui(filename=None):
+    # Qt is only needed by the viewer, so that batch runs and the
+    # service work on machines without it
+    from PySide import QtGui
+    from .image_viewer import ImageViewer
+
     app = QtGui.QApplication(sys.argv)
     window = ImageViewer()
     if filename:
@@ -56,7 +132,225 @@ def launch_gui(filename=None):
     sys.exit(app.exec_())
 
 
-def launch_batch(input_dir=None, output_dir=None, recursive=None):
+def image_files(input_dir, recursive=True, verbose=True):
+    """Paths of the images in `input_dir`."""
+    for root, dirs, files in os.walk(input_dir):
+        if verbose:
+            print("Batch processing folder: '%s'" % root)
+        for filename in sorted(files):
+            if is_image_file(filename):
+                yield os.path.join(root, filename)
+        if not recursive:
+            break
+        dirs.sort()
+
+
+def read_image(filename, reduce=1):
+    """Decode an image straight to grayscale, as segmentation needs.
+
+    With `reduce` of 2, 4 or 8 the image is decoded at that fraction of
+    its size, which libjpeg does much faster than a full decode.
+
+    """
+    flag = getattr(cv2, 'IMREAD_REDUCED_GRAYSCALE_%d' % reduce, None)
+    image = cv2.imread(filename, flag or cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise IOError("Cannot read image '%s'" % filename)
+    if reduce > 1 and flag is None:
+        # OpenCV before 3.2 has no reduced decoding
+        image = cv2.resize(image, (image.shape[1] // reduce,
+                                   image.shape[0] // reduce),
+                           interpolation=cv2.INTER_AREA)
+    return image
+
+
+def segment_image(image, timer=None, parameters=None):
+    """Boxes of an image, by default as found by batch runs."""
+    if not hasattr(_buffers, 'pool'):
+        _buffers.pool = BufferPool()
+    rects, _ = segment_edges(image, timer=timer, buffers=_buffers.pool,
+                             **(parameters or BATCH_PARAMETERS))
+    return deduplicate(rects)
+
+
+def write_rects(filename, boxes):
+    """Write the normalised boxes of an image next to it as CSV."""
+    save_rects(filename + '.csv', boxes)
+
+
+def _measured(metrics, stage, compute):
+    """Run `compute`, storing its duration as `metrics[stage]`."""
+    start = time.time()
+    value = compute()
+    metrics[stage] = time.time() - start
+    return value
+
+
+def _finish_metrics(metrics, shape, boxes, timer):
+    metrics.setdefault('peak_rss', peak_rss())
+    metrics.update(
+        seconds=sum(metrics.get(stage, 0)
+                    for stage in ('read', 'segment', 'write')),
+        megapixels=shape[0] * shape[1] / 1e6,
+        boxes=len(boxes),
+        pid=os.getpid(),
+        stages=timer.records if timer else [])
+    return metrics
+
+
+def segment_file(filename, timings=False, reduce=1, write=True):
+    """Segment one image and write its boxes next to it as CSV.
+
+    Boxes are found at 1 / `reduce` of the image's size.  With `write`
+    false, they are only returned.
+
+    Returns
+    -------
+    (filename, boxes, metrics, error) : tuple
+        The normalised boxes, the metrics of the image and the traceback
+        if it failed.  Metrics are the ``read``, ``segment``, ``write``
+        and total ``seconds``, the ``megapixels`` segmented, the number of
+        ``boxes``, the ``peak_rss`` of the process while it handled the
+        image, the ``pid`` of the process, and the segmentation
+        ``stages`` timing records if `timings` is set.  Where the peak
+        memory cannot be reset, as outside Linux, ``peak_rss`` is the peak
+        of the process so far.
+
+    """
+    timer = StageTimer() if timings else None
+    metrics = {}
+    reset_peak_rss()
+    try:
+        image = _measured(metrics, 'read',
+                          lambda: read_image(filename, reduce))
+        boxes = _measured(metrics, 'segment', lambda: list(normalized_rects(
+            segment_image(image, timer), image.shape[:2])))
+        if write:
+            _measured(metrics, 'write', lambda: write_rects(filename, boxes))
+    except Exception:
+        return filename, [], metrics, traceback.format_exc()
+    return (filename, boxes,
+            _finish_metrics(metrics, image.shape, boxes, timer), None)
+
+
+def _segment_file(args):
+    return segment_file(*args)
+
+
+def _add_timings(timer, metrics):
+    """Print the stage times of an image and add them to `timer`."""
+    records = [{'stage': stage, 'seconds': metrics[stage]}
+               for stage in ('read', 'write') if stage in metrics]
+    records[1:1] = metrics['stages']
+    print("Timings:", ", ".join(
+        "%s %.3f s" % (record['stage'], record['seconds'])
+        for record in records))
+    timer.records.extend(records)
+
+
+def segment_files_pipelined(tasks, depth=2):
+    """Like `segment_file` over `tasks`, with reading and writing overlapped.
+
+    `depth` reader threads decode the next images while the current one
+    is segmented, and a writer thread writes the CSV files.  The queues
+    between the stages hold at most `depth` images, which bounds memory.
+
+    Yields
+    ------
+    result : tuple
+        Result of `segment_file` for each task, in completion order.
+
+    """
+    tasks = iter(tasks)
+    lock = threading.Lock()
+    decoded = Queue(depth)
+    segmented = Queue(depth)
+    finished = Queue()
+    done = object()
+
+    def read():
+        try:
+            while True:
+                with lock:
+                    task = next(tasks, None)
+                if task is None:
+                    return
+                filename, timings, reduce, write_csv = task
+                timer = StageTimer() if timings else None
+                metrics = {}
+                image, error = None, None
+                try:
+                    image = _measured(metrics, 'read',
+                                      lambda: read_image(filename, reduce))
+                except Exception:
+                    error = traceback.format_exc()
+                decoded.put((filename, timer, metrics, image, write_csv,
+                             error))
+        finally:
+            decoded.put(done)
+
+    def write():
+        for filename, timer, metrics, shape, boxes in iter(segmented.get,
+                                                           done):
+            try:
+                _measured(metrics, 'write',
+                          lambda: write_rects(filename, boxes))
+            except Exception:
+                finished.put((filename, [], metrics,
+                              traceback.format_exc()))
+            else:
+                finished.put((filename, boxes,
+                              _finish_metrics(metrics, shape, boxes, timer),
+                              None))
+
+    readers = [threading.Thread(target=read) for _ in range(depth)]
+    writer = threading.Thread(target=write)
+    for thread in readers + [writer]:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        remaining = len(readers)
+        while remaining:
+            item = decoded.get()
+            if item is done:
+                remaining -= 1
+                continue
+            filename, timer, metrics, image, write_csv, error = item
+            if error:
+                yield filename, [], metrics, error
+                continue
+            # Images overlap in the pipeline, so the peak memory of an
+            # image is taken over its segmentation, the largest stage
+            reset_peak_rss()
+            try:
+                boxes = _measured(
+                    metrics, 'segment', lambda: list(normalized_rects(
+                        segment_image(image, timer), image.shape[:2])))
+                metrics['peak_rss'] = peak_rss()
+            except Exception:
+                yield filename, [], metrics, traceback.format_exc()
+            else:
+                if write_csv:
+                    segmented.put((filename, timer, metrics, image.shape,
+                                   boxes))
+                else:
+                    yield filename, boxes, _finish_metrics(
+                        metrics, image.shape, boxes, timer), None
+            item = image = None
+            while not finished.empty():
+                yield finished.get()
+    finally:
+        segmented.put(done)
+        writer.join()
+    while not finished.empty():
+        yield finished.get()
+
+
+def launch_batch(input_dir=None, output_dir=None, recursive=None,
+                 timings=False, jobs=1, incremental=False, checksum=False,
+                 prefetch=0, reduce=1, store=None, database=None,
+                 report=None):
     """
     Launch batch processor.
 
@@ -69,47 +363,387 @@ def launch_batch(input_dir=None, output_dir=None, recursive=None):
     recursive : bool
         Whether to search the input directory recursively.  Default
         is True.
+    timings : bool
+        Print the time of each segmentation stage for every image, and
+        totals at the end.
+    jobs : int
+        Number of images segmented at once, each in its own process.
+    incremental : bool
+        Skip the images whose results, recorded in a manifest in the input
+        directory, are current.
+    checksum : bool
+        With `incremental`, compare the content of images rather than
+        their modification times.
+    prefetch : int
+        With one job, decode up to this many images ahead in reader
+        threads, and write results in a writer thread.
+    reduce : int
+        Decode and segment images at 1 / `reduce` of their size.
+    store : str
+        Write all boxes to this `BoxStore` file rather than a CSV file
+        per image.
+    database : str
+        Also add all boxes to this `BoxDatabase` file.
+    report : str
+        Write a summary of the run, with the metrics of every image, to
+        this JSON file.
+
+    Returns
+    -------
+    failed : list
+        Images that could not be segmented.
 
     """
     if output_dir is None:
         output_dir = "."
     if input_dir is None:
-        intput_dir = "."
+        input_dir = "."
     if recursive is None:
         recursive = True
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for root, dirs, files in os.walk(input_dir):
-        print("Batch processing folder: '%s'" % root)
+    timer = StageTimer() if timings else None
+    parameters = dict(BATCH_PARAMETERS, reduce=reduce)
+    manifest = None
+    if incremental:
+        manifest = Manifest(os.path.join(input_dir, MANIFEST), input_dir)
+    signatures = {}
+    boxes_store = BoxStore(store, input_dir) if store else None
+    boxes_database = BoxDatabase(database) if database else None
+    filenames = list(image_files(input_dir, recursive))
+    progress = BatchReport(total=len(filenames))
 
-        for filename in files:
-            if is_image_file(filename):
-                filename = os.path.join(root, filename)
-                image = io.imread(filename, plugin='matplotlib')
-                height, width, _ = image.shape
+    def tasks():
+        for filename in filenames:
+            if manifest is not None:
+                signature = file_signature(filename, checksum)
+                if boxes_store is None:
+                    current = manifest.is_current(
+                        filename, signature, parameters, filename + '.csv')
+                else:
+                    current = (filename in boxes_store and
+                               manifest.is_current(filename, signature,
+                                                   parameters, store))
+                if current:
+                    signatures[filename] = None
+                    progress.skip()
+                    continue
+                signatures[filename] = signature
+            yield filename, timings, reduce, boxes_store is None
 
-                print("Segmenting", filename, image.shape)
-                rects = segment_edges(image,
-                                      variance_threshold=100,
-                                      size_filter=1)
+    pool = None
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap_unordered(_segment_file, tasks())
+    elif prefetch:
+        results = segment_files_pipelined(tasks(), prefetch)
+    else:
+        results = (segment_file(*task) for task in tasks())
 
-                rects = normalized_rects(rects, (height, width))
-                save_rects(filename + '.csv', rects)
+    failed = []
+    try:
+        for filename, boxes, metrics, error in results:
+            if error:
+                print("Failed to segment", filename)
+                print(error, file=sys.stderr)
+                failed.append(filename)
+                progress.fail(filename)
+                continue
+            print("Segmented", filename, "found", len(boxes), "boxes in",
+                  "%.2f s" % metrics['seconds'])
+            if boxes_store is not None:
+                boxes_store.add(filename, boxes, parameters)
+            if boxes_database is not None:
+                boxes_database.add(filename, boxes, parameters)
+            if manifest is not None:
+                manifest.record(filename, signatures.pop(filename),
+                                parameters, boxes=len(boxes))
+            if timer is not None:
+                _add_timings(timer, metrics)
+            progress.add(filename, metrics)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if boxes_store is not None:
+            print("Writing box store", store)
+            boxes_store.save()
+        if boxes_database is not None:
+            boxes_database.close()
+        if manifest is not None:
+            manifest.close()
 
-        if not recursive:
-            break
+    if manifest is not None:
+        print("Skipped", progress.skipped, "unchanged images")
+
+    progress.progress(force=True)
+    summary = progress.summary()
+    print("Segmented %d images (%.1f MP) in %.1f s, %.2f images/s, "
+          "peak memory %.0f MB, at most %.0f MB per worker" % (
+              summary['images'], summary['megapixels'], summary['seconds'],
+              summary['images_per_second'], summary['peak_rss'] / 2 ** 20,
+              summary['worker_peak_rss'] / 2 ** 20))
+    for filename in summary.get('slow_images', []):
+        print("Slow image:", filename)
+    if report:
+        progress.write(report)
+
+    if timer is not None:
+        print("Total time per stage:")
+        print(timer.summary())
+    if failed:
+        print("%d images failed:" % len(failed))
+        for filename in failed:
+            print("   ", filename)
+    return failed
+
+
+def export_file(filename, boxes, directory):
+    """Write a PNG crop of every box of an image.
+
+    The image is decoded once for all of its boxes, which are normalised
+    (x, y, w, h) as in the CSV files.
+
+    Returns
+    -------
+    (filename, count, error) : tuple
+        The number of crops written, and the traceback if the image
+        failed.
+
+    """
+    try:
+        image = cv2.imread(filename)
+        if image is None:
+            raise IOError("Cannot read image '%s'" % filename)
+        height, width = image.shape[:2]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        for i, (x, y, w, h) in enumerate(boxes):
+            x0 = max(0, int(round(x * width)))
+            y0 = max(0, int(round(y * height)))
+            x1 = min(width, int(round((x + w) * width)))
+            y1 = min(height, int(round((y + h) * height)))
+            crop = os.path.join(directory, "%s_%04d.png" % (name, i))
+            if not cv2.imwrite(crop, image[y0:y1, x0:x1]):
+                raise IOError("Cannot write crop '%s'" % crop)
+    except Exception:
+        return filename, 0, traceback.format_exc()
+    return filename, len(boxes), None
+
+
+def _export_file(args):
+    return export_file(*args)
+
+
+def launch_export(input_dir, output_dir=None, recursive=True, jobs=1,
+                  store=None):
+    """
+    Export the boxes found by a batch run as crops.
+
+    Parameters
+    ----------
+    input_dir : str
+        Directory of the images.
+    output_dir : str
+        Directory that the crops are written to, in a directory per
+        image that mirrors the layout of `input_dir`.  Default is the
+        current directory.
+    recursive : bool
+        Whether to search the input directory recursively.
+    jobs : int
+        Number of images exported at once, each in its own process.
+    store : str
+        Read boxes from this `BoxStore` file rather than from the CSV file
+        next to each image.
+
+    Returns
+    -------
+    failed : list
+        Images whose crops could not be written.
+
+    """
+    if output_dir is None:
+        output_dir = "."
+    boxes = None
+    if store:
+        boxes = BoxStore(store, input_dir)
+
+    def tasks():
+        for filename in image_files(input_dir, recursive):
+            if boxes is not None:
+                if filename not in boxes:
+                    continue
+                rects = boxes.boxes(filename).tolist()
+            elif os.path.exists(filename + '.csv'):
+                rects = read_rects(filename + '.csv')
+            else:
+                continue
+            directory = os.path.join(
+                output_dir,
+                os.path.relpath(os.path.splitext(filename)[0], input_dir))
+            yield filename, rects, directory
+
+    pool = None
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap_unordered(_export_file, tasks())
+    else:
+        results = (export_file(*task) for task in tasks())
+
+    failed = []
+    try:
+        for filename, count, error in results:
+            if error:
+                print("Failed to export", filename)
+                print(error, file=sys.stderr)
+                failed.append(filename)
+            else:
+                print("Exported", count, "crops from", filename)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if failed:
+        print("%d images failed:" % len(failed))
+        for filename in failed:
+            print("   ", filename)
+    return failed
+
+
+def _ignore_interrupts():
+    # Leave Ctrl-C to the watching process, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def watch_folder(input_dir, recursive=False, jobs=1, interval=2.0,
+                 timings=False, reduce=1):
+    """Segment images as they are added to a directory, until interrupted.
+
+    The directory is polled every `interval` seconds.  A new or changed
+    image is queued once its size and modification time are the same on
+    two polls in a row, so that files still being written are left alone.
+    Images are segmented by a pool of `jobs` worker processes started
+    once, and each CSV is written as soon as its image is done.  Results
+    are recorded in the manifest used by incremental batch runs.
+
+    An image that changes while it is being segmented is queued again,
+    and only the result for its latest content is written.
+
+    """
+    parameters = dict(BATCH_PARAMETERS, reduce=reduce)
+    manifest = Manifest(os.path.join(input_dir, MANIFEST), input_dir)
+    timer = StageTimer() if timings else None
+    seen = {}
+    queued = {}
+    failed = {}
+    results = Queue()
+    pool = Pool(jobs, _ignore_interrupts)
+
+    print("Watching '%s' for images" % input_dir)
+    try:
+        while True:
+            for filename in image_files(input_dir, recursive, verbose=False):
+                try:
+                    signature = file_signature(filename)
+                except OSError:
+                    # Removed since the directory was listed
+                    continue
+                if (queued.get(filename) == signature or
+                        failed.get(filename) == signature or
+                        manifest.is_current(filename, signature, parameters,
+                                            filename + '.csv')):
+                    continue
+                if seen.get(filename) == signature:
+                    queued[filename] = signature
+                    pool.apply_async(
+                        segment_file, (filename, timings, reduce, False),
+                        callback=lambda result, signature=signature:
+                        results.put((signature, result)))
+                else:
+                    seen[filename] = signature
+
+            # Report results while waiting for the next poll
+            deadline = time.time() + interval
+            while True:
+                try:
+                    result = results.get(
+                        timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+                signature, (filename, boxes, metrics, error) = result
+                if queued.get(filename) != signature:
+                    # Superseded by a job for newer content
+                    continue
+                del queued[filename]
+                seen.pop(filename, None)
+                if not error:
+                    try:
+                        _measured(metrics, 'write',
+                                  lambda: write_rects(filename, boxes))
+                    except EnvironmentError:
+                        error = traceback.format_exc()
+                if error:
+                    print("Failed to segment", filename)
+                    print(error, file=sys.stderr)
+                    failed[filename] = signature
+                    continue
+                print("Segmented", filename, "found", len(boxes), "boxes")
+                manifest.record(filename, signature, parameters,
+                                boxes=len(boxes))
+                if timer is not None:
+                    _add_timings(timer, metrics)
+    except KeyboardInterrupt:
+        print("Stopped watching '%s'" % input_dir)
+    finally:
+        pool.terminate()
+        pool.join()
+        manifest.close()
+        if timer is not None:
+            print("Total time per stage:")
+            print(timer.summary())
 
 
 def launch():
     arguments = docopt(__doc__, version='Inselect 0.1')
-    if not arguments["--batch"]:
+    if arguments["serve"]:
+        from .server import serve
+        serve(arguments["--host"], int(arguments["--port"]),
+              int(arguments["--jobs"]), int(arguments["--queue"]),
+              int(float(arguments["--max_upload"]) * 2 ** 20))
+    elif arguments["--watch"]:
+        watch_folder(arguments["--watch"],
+                     recursive=arguments["--recursive"],
+                     jobs=int(arguments["--jobs"]),
+                     interval=float(arguments["--interval"]),
+                     timings=arguments["--timings"],
+                     reduce=int(arguments["--reduce"]))
+    elif arguments["--export"]:
+        failed = launch_export(arguments["--export"],
+                               output_dir=arguments["--output_dir"],
+                               recursive=arguments["--recursive"],
+                               jobs=int(arguments["--jobs"]),
+                               store=arguments["--store"])
+        sys.exit(1 if failed else 0)
+    elif not arguments["--batch"]:
         print("Launching gui")
         filename = arguments['<filename>']
         launch_gui(filename)
     else:
         print("Batch processing enabled")
-        launch_batch(output_dir=arguments["--output_dir"],
-                     input_dir=arguments["--batch"],
-                     recursive=arguments["--recursive"])
+        failed = launch_batch(output_dir=arguments["--output_dir"],
+                              input_dir=arguments["--batch"],
+                              recursive=arguments["--recursive"],
+                              timings=arguments["--timings"],
+                              jobs=int(arguments["--jobs"]),
+                              incremental=arguments["--incremental"],
+                              checksum=arguments["--checksum"],
+                              prefetch=int(arguments["--prefetch"] or 0),
+                              reduce=int(arguments["--reduce"]),
+                              store=arguments["--store"],
+                              database=arguments["--database"],
+                              report=arguments["--report"])
+        sys.exit(1 if failed else 0)
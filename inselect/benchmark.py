@@ -0,0 +1,266 @@
+"""Inselect segmentation benchmark.
+
+Times segmentation backends on deterministic synthetic trays and appends
+one JSON record per run to the output file, so that runs can be compared
+over time.
+
+Usage:
+    benchmark.py [options]
+
+Options:
+  -h --help              Show this screen.
+  --sizes=<sizes>        Comma separated image sizes, as HEIGHTxWIDTH
+                         [default: 1500x2000,3000x4000,6000x8000].
+  --specimens=<n>        Specimens per tray [default: 100].
+  --noise=<sigma>        Standard deviation of the pixel noise [default: 4].
+  --contrast=<c>         Specimen to background contrast, from 0 to 1
+                         [default: 0.6].
+  --seed=<n>             Random seed of the tray generator [default: 0].
+  --repeat=<n>           Timed runs per image [default: 3].
+  --functions=<names>    Comma separated backends to time
+                         [default: segment_edges,segment_intensity].
+  --output=<file>        JSON lines file to append results to
+                         [default: benchmark.jsonl].
+"""
+from __future__ import print_function, division
+
+import json
+import platform
+import time
+import traceback
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+import cv2
+import numpy as np
+
+from . import docopt
+from .report import peak_rss
+from .segment import (segment_blobs, segment_edges, segment_edges_pyramid,
+                      segment_edges_streaming, segment_edges_tiled,
+                      segment_intensity)
+
+
+def synthetic_tray(height, width, specimens=100, noise=4, contrast=0.6,
+                   seed=0):
+    """Deterministic image of a specimen tray with known boxes.
+
+    Parameters
+    ----------
+    height, width : int
+        Size of the image.
+    specimens : int
+        Number of specimens, drawn as rotated ellipses with a darker core.
+    noise : float
+        Standard deviation of the Gaussian noise added to every pixel.
+    contrast : float
+        Difference between specimens and background, from 0 (none) to 1.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    (image, rects) : (M, N, 3) array, list
+        BGR image and the bounding rect of every specimen.
+
+    """
+    random = np.random.RandomState(seed)
+    background = 210
+    image = np.empty((height, width, 3), np.uint8)
+    image[:] = (background - 10, background, background + 5)
+    border = max(2, min(height, width) // 400)
+    cv2.rectangle(image, (border, border),
+                  (width - border - 1, height - border - 1),
+                  (60, 60, 60), border)
+
+    scale = min(height, width)
+    rects = []
+    for _ in range(specimens):
+        a = int(scale * random.uniform(0.01, 0.03))
+        b = int(a * random.uniform(0.4, 1.0))
+        angle = random.uniform(0, 180)
+        cx = random.randint(4 * border + a, width - 4 * border - a)
+        cy = random.randint(4 * border + a, height - 4 * border - a)
+        shade = background * (1 - contrast * random.uniform(0.6, 1.0))
+        colour = tuple(float(np.clip(shade * f, 0, 255))
+                       for f in random.uniform(0.7, 1.1, 3))
+        cv2.ellipse(image, (cx, cy), (a, b), angle, 0, 360, colour, -1)
+        core = tuple(0.6 * c for c in colour)
+        cv2.ellipse(image, (cx, cy), (a // 3, b // 3), angle, 0, 360,
+                    core, -1)
+        points = cv2.ellipse2Poly((cx, cy), (a, b), int(angle), 0, 360, 5)
+        rects.append(tuple(int(v) for v in cv2.boundingRect(points)))
+
+    # Noise is added a band at a time, to keep the generator's own peak
+    # memory well below that of the backends being measured
+    for y in range(0, height if noise else 0, 64):
+        band = image[y:y + 64]
+        noisy = band + random.normal(0, noise, band.shape)
+        band[:] = np.clip(noisy, 0, 255)
+    return image, rects
+
+
+def synthetic_texture(height, width, sigma=16, seed=0):
+    """Deterministic image of blurred noise.
+
+    Its edges form contours of every size and depth of nesting all over
+    the image, so that many of them cross tile and strip seams.
+
+    Parameters
+    ----------
+    height, width : int
+        Size of the image.
+    sigma : float
+        Standard deviation of the Gaussian blur, which sets the size of
+        the blobs.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    image : (M, N, 3) array
+        BGR image.
+
+    """
+    random = np.random.RandomState(seed)
+    noise = random.randint(0, 256, (height, width)).astype(np.uint8)
+    blurred = cv2.GaussianBlur(noise, (0, 0), sigma)
+    stretched = cv2.normalize(blurred, None, 0, 255, cv2.NORM_MINMAX)
+    return np.repeat(stretched[:, :, np.newaxis], 3, axis=2)
+
+
+def _edges(segment):
+    """Edge backend with the parameters used by the batch processor."""
+    return lambda image: segment(image, variance_threshold=100,
+                                 size_filter=1)[0]
+
+
+# Backends, by name, as functions of a BGR image returning rects
+FUNCTIONS = {
+    'segment_edges': _edges(segment_edges),
+    'segment_edges_tiled': _edges(segment_edges_tiled),
+    'segment_edges_pyramid': _edges(segment_edges_pyramid),
+    'segment_edges_streaming': _edges(segment_edges_streaming),
+    'segment_intensity': segment_intensity,
+    'segment_blobs': lambda image: segment_blobs(image)[0],
+}
+
+# Backends that must find exactly the rects of segment_edges
+EXACT = set(['segment_edges_tiled', 'segment_edges_streaming'])
+
+
+def _run(name, tray, repeat, results):
+    try:
+        results.put((_measure(name, tray, repeat), None))
+    except Exception:
+        results.put((None, traceback.format_exc()))
+
+
+def _measure(name, tray, repeat):
+    image, _ = synthetic_tray(*tray[:2], **tray[2])
+    before = peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        rects = FUNCTIONS[name](image)
+        times.append(time.time() - start)
+    memory = peak_rss() - before
+    same = None
+    if name in EXACT:
+        texture = synthetic_texture(*tray[:2], seed=tray[2].get('seed', 0))
+        same = all(set(FUNCTIONS[name](test)) ==
+                   set(FUNCTIONS['segment_edges'](test))
+                   for test in (image, texture))
+    return times, len(rects), memory, same
+
+
+def measure(name, height, width, repeat=3, **tray):
+    """Time one backend on one synthetic tray.
+
+    Each measurement runs in a fresh process, so that the peak memory it
+    reports belongs to that backend and image alone.
+
+    Returns
+    -------
+    record : dict
+        Latencies in seconds, throughput in megapixels per second, the
+        peak memory added by segmentation, in bytes, and for the backends
+        in `EXACT` whether they found the same rects as `segment_edges`,
+        both on the tray and on a `synthetic_texture` of its size.  If the
+        backend raised or its process died, as when killed for running out
+        of memory, these are None and ``error`` says why.
+
+    """
+    results = Queue()
+    process = Process(target=_run,
+                      args=(name, (height, width, tray), repeat, results))
+    process.start()
+    outcome = None
+    while outcome is None:
+        try:
+            outcome = results.get(timeout=1)
+        except Empty:
+            # A process that died without a result never sends one
+            if process.exitcode is not None and results.empty():
+                outcome = None, ("Benchmark process exited with code %d" %
+                                 process.exitcode)
+    process.join()
+    measured, error = outcome
+    record = {
+        'function': name,
+        'height': height,
+        'width': width,
+        'tray': tray,
+        'repeat': repeat,
+        'latency': None,
+        'latency_min': None,
+        'megapixels_per_second': None,
+        'peak_memory': None,
+        'rects': None,
+        'same_as_segment_edges': None,
+        'error': error,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+    }
+    if measured:
+        times, count, memory, same = measured
+        record.update(latency=float(np.median(times)),
+                      latency_min=min(times),
+                      megapixels_per_second=height * width / 1e6 / min(times),
+                      peak_memory=memory,
+                      rects=count,
+                      same_as_segment_edges=same)
+    return record
+
+
+def main(argv=None):
+    arguments = docopt(__doc__, argv=argv)
+    sizes = [tuple(int(v) for v in size.split('x'))
+             for size in arguments['--sizes'].split(',')]
+    tray = dict(specimens=int(arguments['--specimens']),
+                noise=float(arguments['--noise']),
+                contrast=float(arguments['--contrast']),
+                seed=int(arguments['--seed']))
+    repeat = int(arguments['--repeat'])
+
+    with open(arguments['--output'], 'a') as output:
+        for name in arguments['--functions'].split(','):
+            for height, width in sizes:
+                record = measure(name, height, width, repeat, **tray)
+                if record['error']:
+                    print("%-20s %6dx%-6d failed: %s" % (
+                        name, height, width,
+                        record['error'].strip().splitlines()[-1]))
+                else:
+                    print("%-20s %6dx%-6d %8.3f s %8.1f MP/s %8.1f MB" % (
+                        name, height, width, record['latency'],
+                        record['megapixels_per_second'],
+                        record['peak_memory'] / 2 ** 20))
+                if record['same_as_segment_edges'] is False:
+                    print("%-20s differs from segment_edges" % name)
+                output.write(json.dumps(record, sort_keys=True) + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Post-processing of segmented boxes.
+
+Segmentation returns nested and overlapping rects, from the contour
+hierarchy and from merging the results of windows.  The functions here
+remove and merge duplicates using a uniform grid index, so that each rect
+is only compared with the rects near it.
+"""
+from collections import defaultdict
+
+import numpy as np
+
+
+class GridIndex(object):
+    """Uniform grid of rects, for finding the rects that overlap a region.
+
+    Parameters
+    ----------
+    cell : int
+        Side of the grid cells, in pixels.  Close to the typical rect size
+        works best.
+
+    """
+
+    def __init__(self, cell):
+        self.cell = max(1, int(cell))
+        self.cells = defaultdict(list)
+        self.rects = {}
+
+    def _cells(self, rect):
+        x, y, w, h = rect
+        c = self.cell
+        for i in xrange(int(x // c), int((x + max(w, 1) - 1) // c) + 1):
+            for j in xrange(int(y // c), int((y + max(h, 1) - 1) // c) + 1):
+                yield i, j
+
+    def insert(self, key, rect):
+        """Add, or move, the rect stored under `key`."""
+        old = self.rects.get(key)
+        self.rects[key] = rect
+        for cell in self._cells(rect):
+            if old is None or key not in self.cells[cell]:
+                self.cells[cell].append(key)
+
+    def query(self, rect):
+        """Keys of the stored rects that overlap `rect`."""
+        x, y, w, h = rect
+        found = set()
+        for cell in self._cells(rect):
+            for key in self.cells.get(cell, ()):
+                if key in found:
+                    continue
+                ox, oy, ow, oh = self.rects[key]
+                if ox < x + w and x < ox + ow and oy < y + h and y < oy + oh:
+                    found.add(key)
+        return found
+
+
+def _overlap(a, b):
+    """Intersection area of two rects."""
+    w = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    h = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    return max(0, w) * max(0, h)
+
+
+def _union(a, b):
+    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+    x1 = max(a[0] + a[2], b[0] + b[2])
+    y1 = max(a[1] + a[3], b[1] + b[3])
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def deduplicate(rects, iou=0.5, contained=0.9, merge=False, scores=None):
+    """Non-maximum suppression of overlapping rects.
+
+    Rects are visited from the highest score down.  A rect is a duplicate
+    of an already kept rect when their intersection over union is at
+    least `iou`, or when at least a `contained` fraction of it lies
+    inside the kept rect.
+
+    Parameters
+    ----------
+    rects : list of (x, y, w, h)
+        Rects to clean up.
+    iou : float
+        Least intersection over union of duplicates.
+    contained : float or None
+        Least fraction of a rect inside a kept rect for it to be a
+        duplicate.  None keeps nested rects.
+    merge : bool
+        Grow each kept rect to the union of its duplicates, rather than
+        dropping them.
+    scores : sequence of float
+        Preference of each rect.  By default larger rects are kept.
+
+    Returns
+    -------
+    rects : list
+        Kept rects, in their original order.
+
+    """
+    rects = [tuple(rect) for rect in rects]
+    if not rects:
+        return []
+    if scores is None:
+        scores = [w * h for x, y, w, h in rects]
+    order = np.argsort(-np.asarray(scores, np.float64), kind='mergesort')
+    sizes = [max(w, h) for x, y, w, h in rects]
+    index = GridIndex(2 * np.median(sizes))
+
+    kept = {}
+    for i in order:
+        rect = rects[i]
+        area = rect[2] * rect[3]
+        for j in sorted(index.query(rect)):
+            other = kept[j]
+            inter = _overlap(rect, other)
+            union = area + other[2] * other[3] - inter
+            if ((union and inter >= iou * union) or
+                    (contained is not None and area and
+                     inter >= contained * area)):
+                if merge:
+                    kept[j] = _union(other, rect)
+                    index.insert(j, kept[j])
+                break
+        else:
+            kept[i] = rect
+            index.insert(i, rect)
+    return [kept[i] for i in sorted(kept)]
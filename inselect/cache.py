@@ -0,0 +1,104 @@
+"""Memory reuse for the segmentation pipeline.
+
+`StageCache` keeps intermediate results of recent images; `BufferPool`
+keeps working arrays for the next image of the same shape.
+
+"""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+def image_key(image):
+    """Identity of an image's content.
+
+    Hashes the shape, type and a regular sample of about 64k pixels, so
+    that the same image read twice maps to the same key without hashing
+    every pixel of a large scan.
+
+    """
+    step = max(1, int(np.sqrt(image.shape[0] * image.shape[1] / 65536.)))
+    sample = np.ascontiguousarray(image[::step, ::step])
+    return (image.shape, image.dtype.str,
+            hashlib.sha1(sample.tostring()).hexdigest())
+
+
+def nbytes(value):
+    """Approximate memory held by arrays in a (nested) stage result."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+class StageCache(object):
+    """Least recently used cache of pipeline stage results.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory budget for cached arrays.  Least recently used entries are
+        evicted to stay within it, and larger results are not cached.
+
+    """
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """Return the result stored under `key`, computing it if missing."""
+        if key in self.entries:
+            self.hits += 1
+            value, size = self.entries.pop(key)
+            self.entries[key] = (value, size)
+            return value
+        self.misses += 1
+        value = compute()
+        size = nbytes(value)
+        if size <= self.max_bytes:
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+def cached(cache, key, compute):
+    """Call `compute`, through `cache` unless it is None."""
+    if cache is None:
+        return compute()
+    return cache.get(key, compute)
+
+
+class BufferPool(object):
+    """Working arrays reused across calls on images of the same shape.
+
+    One array is kept per name, and replaced when a different shape or type
+    is asked for, so memory stays bounded by the largest image in use.
+    Arrays handed out are overwritten by the next call using the pool, and
+    a pool must not be shared between threads.
+
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype):
+        """Array called `name`, allocated if missing or of another shape."""
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or \
+                buffer.dtype != np.dtype(dtype):
+            buffer = self.buffers[name] = np.empty(shape, dtype)
+        return buffer
+
+    def clear(self):
+        self.buffers.clear()
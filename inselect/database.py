@@ -0,0 +1,137 @@
+"""SQLite database of boxes, for queries across collections.
+
+Tables
+------
+``runs``
+    One row per distinct set of segmentation parameters, as JSON.
+``images``
+    Absolute path of each image, its run and its number of boxes.
+``boxes``
+    Boxes of each image, normalised by the image size as in the CSV
+    files, with their normalised ``area``.
+
+Images, box counts, box areas and runs are indexed, so that queries such
+as ::
+
+    SELECT path FROM images WHERE boxes > 200
+    SELECT path, x, y, w, h FROM boxes JOIN images ON image = images.id
+        WHERE area < 0.0001
+
+stay fast over millions of boxes.
+"""
+import json
+import os
+import sqlite3
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    parameters TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    run INTEGER REFERENCES runs (id),
+    boxes INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS boxes (
+    id INTEGER PRIMARY KEY,
+    image INTEGER NOT NULL REFERENCES images (id),
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    w REAL NOT NULL,
+    h REAL NOT NULL,
+    area REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_run ON images (run);
+CREATE INDEX IF NOT EXISTS images_boxes ON images (boxes);
+CREATE INDEX IF NOT EXISTS boxes_image ON boxes (image);
+CREATE INDEX IF NOT EXISTS boxes_area ON boxes (area);
+"""
+
+
+class BoxDatabase(object):
+    """Box database being written to.
+
+    Images are buffered and inserted `batch_size` at a time, each batch
+    in one transaction.  Adding an image again replaces its boxes.
+
+    Parameters
+    ----------
+    path : str
+        Database file, created if needed.
+    batch_size : int
+        Images per transaction.
+
+    """
+
+    def __init__(self, path, batch_size=100):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.pending = []
+        self.runs = dict(self.connection.execute(
+            "SELECT parameters, id FROM runs"))
+
+    def add(self, image, boxes, parameters=None):
+        """Queue the normalised (x, y, w, h) boxes of an image.
+
+        The image path is made absolute, so that an image added from
+        different working directories or spellings of its path has one
+        row.
+
+        """
+        boxes = [tuple(float(v) for v in box) for box in boxes]
+        self.pending.append((os.path.abspath(image), boxes,
+                             json.dumps(parameters, sort_keys=True)))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def _run(self, parameters):
+        if parameters not in self.runs:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (parameters) VALUES (?)", (parameters,))
+            self.runs[parameters] = cursor.lastrowid
+        return self.runs[parameters]
+
+    def flush(self):
+        """Insert the queued images in one transaction."""
+        if not self.pending:
+            return
+        now = time.time()
+        try:
+            self._insert(now)
+        except sqlite3.Error:
+            # Runs added by the rolled back transaction are gone too
+            self.runs = dict(self.connection.execute(
+                "SELECT parameters, id FROM runs"))
+            raise
+        del self.pending[:]
+
+    def _insert(self, now):
+        with self.connection:
+            for image, boxes, parameters in self.pending:
+                self.connection.execute(
+                    "DELETE FROM boxes WHERE image IN "
+                    "(SELECT id FROM images WHERE path = ?)", (image,))
+                self.connection.execute(
+                    "DELETE FROM images WHERE path = ?", (image,))
+                image_id = self.connection.execute(
+                    "INSERT INTO images (path, run, boxes, updated) "
+                    "VALUES (?, ?, ?, ?)",
+                    (image, self._run(parameters), len(boxes),
+                     now)).lastrowid
+                self.connection.executemany(
+                    "INSERT INTO boxes (image, x, y, w, h, area) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(image_id, x, y, w, h, w * h)
+                     for x, y, w, h in boxes])
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,174 @@
+"""Inselect segmentation accuracy check.
+
+Runs segmentation backends over a corpus of images with ground truth
+boxes, and reports precision, recall and mean IoU next to the time spent
+on each image. The ground truth of `image.jpg` is read from
+`image.jpg.csv`, in the normalised format written by the batch processor.
+
+Usage:
+    evaluate.py <corpus_dir> [options]
+
+Options:
+  -h --help              Show this screen.
+  --recursive            Include images in subdirectories.
+  --functions=<names>    Comma separated backends to evaluate
+                         [default: segment_edges].
+  --iou=<t>              Least IoU for a box to match the ground truth
+                         [default: 0.5].
+  --output=<file>        Write per-image and summary results as JSON.
+"""
+from __future__ import print_function, division
+
+import csv
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from . import docopt
+from .benchmark import FUNCTIONS
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.tiff', '.png')
+
+
+def load_rects(filename, (height, width)):
+    """Read normalised boxes from a CSV file as pixel rects."""
+    with open(filename) as csvfile:
+        rows = [map(float, row) for row in csv.reader(csvfile, delimiter=' ')
+                if row]
+    return [(x * width, y * height, w * width, h * height)
+            for x, y, w, h in rows]
+
+
+def iou_matrix(a, b):
+    """Intersection over union of every rect in `a` with every rect in `b`."""
+    a = np.asarray(a, np.float64).reshape(-1, 4)
+    b = np.asarray(b, np.float64).reshape(-1, 4)
+    ax0, ay0 = a[:, 0:1], a[:, 1:2]
+    ax1, ay1 = ax0 + a[:, 2:3], ay0 + a[:, 3:4]
+    bx0, by0 = b[:, 0], b[:, 1]
+    bx1, by1 = bx0 + b[:, 2], by0 + b[:, 3]
+    w = np.clip(np.minimum(ax1, bx1) - np.maximum(ax0, bx0), 0, None)
+    h = np.clip(np.minimum(ay1, by1) - np.maximum(ay0, by0), 0, None)
+    inter = w * h
+    union = (a[:, 2:3] * a[:, 3:4]) + (b[:, 2] * b[:, 3]) - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0)
+
+
+def match_rects(found, truth, threshold=0.5):
+    """Pair found rects with ground truth rects, best overlap first.
+
+    Each rect is used at most once, and only pairs with an IoU of at
+    least `threshold` are matched.
+
+    Returns
+    -------
+    ious : list
+        IoU of every matched pair.
+
+    """
+    ious = iou_matrix(found, truth)
+    pairs = np.argwhere(ious >= threshold)
+    order = np.argsort(-ious[pairs[:, 0], pairs[:, 1]], kind='mergesort')
+    used_found, used_truth, matched = set(), set(), []
+    for i, j in pairs[order]:
+        if i not in used_found and j not in used_truth:
+            used_found.add(i)
+            used_truth.add(j)
+            matched.append(float(ious[i, j]))
+    return matched
+
+
+def corpus(input_dir, recursive=False):
+    """Yield the images in `input_dir` that have a ground truth CSV."""
+    for root, dirs, files in os.walk(input_dir):
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            if (name.lower().endswith(IMAGE_EXTENSIONS) and
+                    os.path.isfile(filename + '.csv')):
+                yield filename
+        if not recursive:
+            break
+        dirs.sort()
+
+
+def evaluate(function, filenames, threshold=0.5):
+    """Score one backend over a list of images.
+
+    Returns
+    -------
+    (images, summary) : list, dict
+        A record per image, and totals over the corpus. Precision and
+        recall are computed over all boxes rather than averaged per image.
+
+    """
+    segment = FUNCTIONS[function]
+    images = []
+    for filename in filenames:
+        image = cv2.imread(filename)
+        truth = load_rects(filename + '.csv', image.shape[:2])
+        start = time.time()
+        found = segment(image)
+        seconds = time.time() - start
+        matched = match_rects(found, truth, threshold)
+        images.append({
+            'filename': filename,
+            'found': len(found),
+            'truth': len(truth),
+            'matched': len(matched),
+            'iou': sum(matched),
+            'seconds': seconds,
+            'megapixels': image.shape[0] * image.shape[1] / 1e6,
+        })
+
+    total = dict((key, sum(record[key] for record in images))
+                 for key in ('found', 'truth', 'matched', 'iou', 'seconds',
+                             'megapixels'))
+    summary = {
+        'function': function,
+        'images': len(images),
+        'iou_threshold': threshold,
+        'precision': total['matched'] / max(total['found'], 1),
+        'recall': total['matched'] / max(total['truth'], 1),
+        'mean_iou': total['iou'] / max(total['matched'], 1),
+        'seconds': total['seconds'],
+        'megapixels_per_second':
+            total['megapixels'] / max(total['seconds'], 1e-9),
+    }
+    for record in images:
+        record['mean_iou'] = record.pop('iou') / max(record['matched'], 1)
+    return images, summary
+
+
+def main(argv=None):
+    arguments = docopt(__doc__, argv=argv)
+    filenames = list(corpus(arguments['<corpus_dir>'],
+                            arguments['--recursive']))
+    threshold = float(arguments['--iou'])
+
+    results = {}
+    for function in arguments['--functions'].split(','):
+        images, summary = evaluate(function, filenames, threshold)
+        for record in images:
+            print("%-40s %4d/%-4d matched %5.3f IoU %8.3f s" % (
+                os.path.relpath(record['filename'],
+                                arguments['<corpus_dir>']),
+                record['matched'], record['truth'], record['mean_iou'],
+                record['seconds']))
+        print("%s: precision %.3f recall %.3f mean IoU %.3f "
+              "in %.2f s (%.1f MP/s)" % (
+                  function, summary['precision'], summary['recall'],
+                  summary['mean_iou'], summary['seconds'],
+                  summary['megapixels_per_second']))
+        results[function] = {'images': images, 'summary': summary}
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,14 @@ from PySide import QtCore, QtGui
 from .qt_util import read_qt_image
 from .graphics import GraphicsView, GraphicsScene, BoxResizable
 
-from segment import segment_edges, segment_intensity
-
-from multiprocessing import Process, Queue
+from segment import segment_edges, segment_intensity_windows
+from .cache import StageCache
+from .boxes import deduplicate
+from .timing import StageTimer
+from .database import BoxDatabase
+
+import threading
+import traceback
 import os
 import sys
 import csv
@@ -47,8 +52,13 @@ class ImageViewer(QtGui.QMainWindow):
         self.scene.addItem(item)
         self.image_item = item
         self.scene.image = item
+        self.segment_cache = StageCache()
+        self.segment_image = None
+        self.cv_image = None
+        self.auto_boxes = {}
         self.create_actions()
         self.create_menus()
+        self.create_segment_controls()
 
         self.setWindowTitle("Image Viewer")
         self.resize(500, 400)
@@ -68,6 +78,9 @@ class ImageViewer(QtGui.QMainWindow):
                 return
             for item in list(self.view.items):
                 self.view.remove_item(item)
+            self.segment_image = None
+            self.cv_image = None
+            self.auto_boxes = {}
 
             self.image_item.setPixmap(QtGui.QPixmap.fromImage(image))
             self.scene.setSceneRect(0, 0, image.width(), image.height())
@@ -99,6 +112,61 @@ class ImageViewer(QtGui.QMainWindow):
             b = box.boundingRect()
             box.setZValue(max(1000, 1E9 - b.width() * b.height()))
             box.updateResizeHandles()
+        return box
+
+    def source_image(self):
+        """The open image in OpenCV's BGR layout, decoded once per file."""
+        if self.cv_image is None:
+            self.cv_image = cv2.imread(self.filename)
+        return self.cv_image
+
+    def segment_parameters(self):
+        return dict(threshold=self.threshold_slider.value(),
+                    variance_threshold=self.variance_slider.value() or None,
+                    size_filter=self.size_filter_box.isChecked())
+
+    def update_boxes(self, rects):
+        """Replace the boxes of the previous segmentation with `rects`.
+
+        Boxes whose rect did not change are left alone, as are boxes the
+        user added, and boxes the user deleted are not brought back.
+
+        """
+        rects = set(tuple(rect) for rect in rects)
+        for rect, box in self.auto_boxes.items():
+            if rect not in rects:
+                if box in self.view.items:
+                    self.view.remove_item(box)
+                del self.auto_boxes[rect]
+        for rect in rects:
+            if rect not in self.auto_boxes:
+                self.auto_boxes[rect] = self.add_box(rect)
+
+    def resegment(self):
+        """Re-run the last full segmentation with the current controls.
+
+        The gradient magnitude and contours of the image are cached, so
+        this only repeats the stages that depend on the changed values.
+
+        """
+        if self.segment_image is None:
+            return
+        timer = StageTimer()
+        rects, self.display = segment_edges(self.segment_image,
+                                            cache=self.segment_cache,
+                                            timer=timer,
+                                            **self.segment_parameters())
+        self.update_boxes(deduplicate(rects))
+        self.show_timings(timer)
+
+    def show_timings(self, timer):
+        """Show the slowest stages of the last segmentation."""
+        totals = timer.totals()
+        stages = sorted(totals, key=lambda stage: -totals[stage]['seconds'])
+        self.statusBar().showMessage("Segmented in %.2f s: %s" % (
+            sum(total['seconds'] for total in totals.values()),
+            ", ".join("%s %.2f s" % (stage, totals[stage]['seconds'])
+                      for stage in stages[:3])))
 
     def segment(self):
         self.progressDialog = QtGui.QProgressDialog(self)
@@ -107,41 +175,77 @@ class ImageViewer(QtGui.QMainWindow):
         self.progressDialog.setMaximum(0)
         self.progressDialog.setMinimum(0)
         self.progressDialog.show()
-        image = cv2.imread(self.filename)
-
-        def f(image, results_queue, window=None):
-            rects = segment_edges(image,
-                                  window=window,
-                                  variance_threshold=100,
-                                  size_filter=1)
-            results_queue.put(rects)
-
-        results = Queue()
+        image = self.source_image()
+        parameters = self.segment_parameters()
+        timer = StageTimer()
+
+        def f(image, results, window=None):
+            try:
+                results.append(segment_edges(image,
+                                             window=window,
+                                             cache=self.segment_cache,
+                                             timer=timer,
+                                             **parameters))
+            except Exception:
+                errors.append(traceback.format_exc())
+
+        results, errors = [], []
         window = None
         selected = self.scene.selectedItems()
         if selected:
-            selected = selected[0]
-            window_rect = selected.map_rect_to_scene(selected._rect)
-            p = window_rect.topLeft()
-            window = [p.x(), p.y(), window_rect.width(), window_rect.height()]
-            rects = segment_intensity(image, window=window)
-            self.view.remove_item(selected)
+            # Re-segment every selected box in one batched call
+            window = []
+            for item in selected:
+                window_rect = item.map_rect_to_scene(item._rect)
+                p = window_rect.topLeft()
+                window.append([p.x(), p.y(),
+                               window_rect.width(), window_rect.height()])
+            rects = deduplicate([rect for window_rects in
+                                 segment_intensity_windows(image, window)
+                                 for rect in window_rects])
+            for item in selected:
+                self.view.remove_item(item)
+            for rect in rects:
+                self.add_box(rect)
         else:
-            p = Process(target=f, args=[image, results, window])
-            p.start()
-            while p.is_alive():
-                self.app.processEvents()
-                p.join(0.1)
-            rects, display = results.get()
-        for rect in rects:
-            self.add_box(rect)
-        self.display = display
+            # Segment in a thread so that the cache outlives the run and
+            # the sliders can re-segment from it.  Re-segmenting or
+            # opening another image meanwhile would use the cache and
+            # boxes that the thread is still filling in, so the controls
+            # are disabled until it finishes.
+            self.resegment_timer.stop()
+            busy = [self.segment_controls, self.segment_action,
+                    self.open_action]
+            for widget in busy:
+                widget.setEnabled(False)
+            try:
+                p = threading.Thread(target=f,
+                                     args=[image, results, window])
+                p.start()
+                while p.is_alive():
+                    self.app.processEvents()
+                    p.join(0.1)
+            finally:
+                for widget in busy:
+                    widget.setEnabled(True)
+            if not results:
+                self.progressDialog.hide()
+                sys.stderr.write("".join(errors))
+                QtGui.QMessageBox.warning(
+                    self, "Image Viewer", "Segmentation failed: %s" %
+                    errors[-1].strip().splitlines()[-1])
+                return
+            rects, self.display = results[0]
+            self.segment_image = image
+            # Pressing F5 again keeps the boxes that did not change
+            self.update_boxes(deduplicate(rects))
+            self.show_timings(timer)
         self.progressDialog.hide()
 
     def export(self):
         path = QtGui.QFileDialog.getExistingDirectory(
             self, "Export Destination", QtCore.QDir.currentPath())
-        image = cv2.imread(self.filename)
+        image = self.source_image()
 
         for i, item in enumerate(self.view.items):
             b = item._rect
@@ -207,23 +311,27 @@ class ImageViewer(QtGui.QMainWindow):
         file_name, filtr = QtGui.QFileDialog.getSaveFileName(
             self,
             "QFileDialog.getSaveFileName()",
-            self.file_name + ".csv",
-            "All Files (*);;CSV Files (*.csv)", "",
+            self.filename + ".csv",
+            "All Files (*);;CSV Files (*.csv);;Box databases (*.db)", "",
             QtGui.QFileDialog.Options())
         if file_name:
-            with open(file_name, 'w') as csvfile:
-                writer = csv.writer(csvfile, delimiter=' ')
-                for item in self.view.items:
-                    rect = item.rect()
-                    box = [rect.left(), rect.top(),
-                           rect.width(), rect.height()]
-                    width = self.image_item.pixmap().width()
-                    height = self.image_item.pixmap().height()
-                    box[0] /= width
-                    box[1] /= height
-                    box[2] /= width
-                    box[3] /= height
-                    writer.writerow(box)
+            width = self.image_item.pixmap().width()
+            height = self.image_item.pixmap().height()
+            boxes = []
+            for item in self.view.items:
+                rect = item.rect()
+                boxes.append([rect.left() / width, rect.top() / height,
+                              rect.width() / width, rect.height() / height])
+            if os.path.splitext(file_name)[1].lower() in ('.db', '.sqlite'):
+                # Boxes placed by hand have no segmentation parameters
+                database = BoxDatabase(file_name)
+                database.add(self.filename, boxes)
+                database.close()
+            else:
+                with open(file_name, 'w') as csvfile:
+                    writer = csv.writer(csvfile, delimiter=' ')
+                    for box in boxes:
+                        writer.writerow(box)
 
     def import_boxes(self):
         files, filtr = QtGui.QFileDialog.getOpenFileNames(
@@ -279,6 +387,44 @@ class ImageViewer(QtGui.QMainWindow):
         self.menuBar().addMenu(self.viewMenu)
         self.menuBar().addMenu(self.helpMenu)
 
+    def create_segment_controls(self):
+        self.threshold_slider = QtGui.QSlider(QtCore.Qt.Horizontal)
+        self.threshold_slider.setRange(1, 254)
+        self.threshold_slider.setValue(12)
+        self.variance_slider = QtGui.QSlider(QtCore.Qt.Horizontal)
+        self.variance_slider.setRange(0, 2000)
+        self.variance_slider.setValue(100)
+        self.size_filter_box = QtGui.QCheckBox("Reject large objects")
+        self.size_filter_box.setChecked(True)
+
+        # Coalesce slider drags into one re-segmentation per pause
+        self.resegment_timer = QtCore.QTimer(self)
+        self.resegment_timer.setSingleShot(True)
+        self.resegment_timer.setInterval(50)
+        self.resegment_timer.timeout.connect(self.resegment)
+
+        layout = QtGui.QFormLayout()
+        for name, slider in [("Threshold", self.threshold_slider),
+                             ("Variance", self.variance_slider)]:
+            value = QtGui.QLabel(str(slider.value()))
+            slider.valueChanged.connect(value.setNum)
+            slider.valueChanged.connect(
+                lambda value: self.resegment_timer.start())
+            row = QtGui.QHBoxLayout()
+            row.addWidget(slider)
+            row.addWidget(value)
+            layout.addRow(name, row)
+        self.size_filter_box.stateChanged.connect(
+            lambda state: self.resegment_timer.start())
+        layout.addRow(self.size_filter_box)
+
+        self.segment_controls = QtGui.QWidget()
+        self.segment_controls.setLayout(layout)
+        self.segment_dock = QtGui.QDockWidget("Segmentation", self)
+        self.segment_dock.setWidget(self.segment_controls)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.segment_dock)
+        self.viewMenu.addAction(self.segment_dock.toggleViewAction())
+
     def keyPressEvent(self, event):
         return
         if event.key() == 16777216:
@@ -0,0 +1,90 @@
+"""Record of the images a batch run has segmented.
+
+The manifest lets an interrupted or repeated batch run skip the images
+whose results are current.  It is a JSON lines file with one entry per
+segmented image, appended as each image completes, so that progress
+survives an interruption; later entries for a path replace earlier ones.
+"""
+import hashlib
+import json
+import os
+
+
+def file_signature(filename, checksum=False):
+    """Size and modification time of a file, or size and SHA-1 digest."""
+    stat = os.stat(filename)
+    signature = {'size': stat.st_size}
+    if checksum:
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
+        signature['sha1'] = digest.hexdigest()
+    else:
+        signature['mtime'] = stat.st_mtime
+    return signature
+
+
+class Manifest(object):
+    """Segmentation results recorded by earlier runs over a directory.
+
+    Parameters
+    ----------
+    path : str
+        Manifest file, created on the first `record`.
+    root : str
+        Directory that image paths are stored relative to, so that the
+        collection can be moved.
+
+    """
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partial line from an interrupted run
+                        continue
+                    self.entries[entry['path']] = entry
+        self._file = None
+
+    def _key(self, filename):
+        return os.path.relpath(filename, self.root)
+
+    def is_current(self, filename, signature, parameters, output):
+        """Whether `filename` was segmented, unchanged, with `parameters`,
+        and its `output` file still exists."""
+        entry = self.entries.get(self._key(filename))
+        return (entry is not None and
+                entry['signature'] == signature and
+                entry['parameters'] == parameters and
+                os.path.exists(output))
+
+    def record(self, filename, signature, parameters, **results):
+        """Add the entry of a segmented image and write it out at once."""
+        entry = dict(results, path=self._key(filename),
+                     signature=signature, parameters=parameters)
+        # Round trip, so that entries compare equal to those loaded later
+        entry = json.loads(json.dumps(entry))
+        self.entries[entry['path']] = entry
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def close(self):
+        """Rewrite the manifest with one entry per image."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                for key in sorted(self.entries):
+                    f.write(json.dumps(self.entries[key], sort_keys=True) +
+                            '\n')
+            os.rename(temporary, self.path)
@@ -0,0 +1,170 @@
+"""Progress and throughput of batch runs.
+
+Batch workers measure each image they process; `BatchReport` collects
+those metrics, prints the rate and estimated time left as the run goes,
+and sums them up at the end.
+"""
+from __future__ import print_function, division
+
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+
+def peak_rss():
+    """Peak resident memory of this process so far, in bytes.
+
+    That is since the last successful `reset_peak_rss`, if any.
+
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def reset_peak_rss():
+    """Restart the peak memory of this process from its current size.
+
+    Only Linux can do this, through ``/proc/self/clear_refs``.
+
+    Returns
+    -------
+    reset : bool
+        Whether the peak was reset.
+
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class BatchReport(object):
+    """Metrics of the images of a batch run.
+
+    Parameters
+    ----------
+    total : int
+        Number of images in the run, for the estimated time left.
+    interval : float
+        Least time, in seconds, between progress lines.
+    slow : float
+        Images that take more than `slow` times the median are listed in
+        the summary.
+
+    """
+
+    def __init__(self, total=None, interval=5.0, slow=10.0):
+        self.total = total
+        self.interval = interval
+        self.slow = slow
+        self.started = time.time()
+        self.reported = self.started
+        self.images = []
+        self.failed = []
+        self.skipped = 0
+
+    def add(self, filename, metrics):
+        """Record the metrics of a processed image."""
+        record = dict((key, value) for key, value in metrics.items()
+                      if key != 'stages')
+        record['filename'] = filename
+        self.images.append(record)
+        self.progress()
+
+    def fail(self, filename):
+        self.failed.append(filename)
+        self.progress()
+
+    def skip(self):
+        self.skipped += 1
+
+    def progress(self, force=False):
+        """Print the rate and time left, at most once an `interval`."""
+        now = time.time()
+        if not force and now - self.reported < self.interval:
+            return
+        self.reported = now
+        done = len(self.images) + len(self.failed)
+        elapsed = max(now - self.started, 1e-9)
+        rate = done / elapsed
+        line = "Progress: %d images, %.2f images/s, %.1f MP/s" % (
+            done, rate,
+            sum(image['megapixels'] for image in self.images) / elapsed)
+        if self.total is not None and rate > 0:
+            remaining = max(0, self.total - self.skipped - done)
+            line += ", %d left, ETA %s" % (remaining,
+                                           _duration(remaining / rate))
+        print(line)
+
+    def summary(self):
+        """Totals, rates and per-stage statistics of the run."""
+        elapsed = time.time() - self.started
+        summary = {
+            'images': len(self.images),
+            'failed': len(self.failed),
+            'skipped': self.skipped,
+            'seconds': elapsed,
+            'images_per_second': len(self.images) / max(elapsed, 1e-9),
+            'megapixels': sum(image['megapixels'] for image in self.images),
+            'boxes': sum(image['boxes'] for image in self.images),
+            'failed_images': self.failed,
+        }
+        summary.update(self._memory())
+        summary['megapixels_per_second'] = (summary['megapixels'] /
+                                            max(elapsed, 1e-9))
+        for stage in ('read', 'segment', 'write', 'seconds'):
+            values = [image[stage] for image in self.images if stage in image]
+            if values:
+                summary[stage if stage != 'seconds' else 'image'] = {
+                    'total': float(np.sum(values)),
+                    'mean': float(np.mean(values)),
+                    'median': float(np.median(values)),
+                    'max': float(np.max(values)),
+                }
+        if self.images:
+            median = np.median([image['seconds'] for image in self.images])
+            summary['slow_images'] = [
+                image['filename'] for image in
+                sorted(self.images, key=lambda image: -image['seconds'])
+                if image['seconds'] > self.slow * median]
+        return summary
+
+    def _memory(self):
+        """Peak memory of the run, in bytes.
+
+        ``worker_peak_rss`` is the largest peak of a single worker, and
+        ``peak_rss`` adds the peaks of this process and of every worker
+        process.  Workers may not all peak at once, so ``peak_rss`` is an
+        upper bound on the memory the run needed.  The peak of a process
+        is the largest of those of the images it processed, since
+        measuring them restarts its own.
+
+        """
+        parent = os.getpid()
+        workers = {parent: peak_rss()}
+        for image in self.images:
+            pid = image.get('pid', parent)
+            workers[pid] = max(workers.get(pid, 0), image['peak_rss'])
+        own = workers.pop(parent)
+        return {
+            'worker_peak_rss': max(workers.values() or [own]),
+            'peak_rss': own + sum(workers.values()),
+        }
+
+    def write(self, filename):
+        """Save the summary and the metrics of every image as JSON."""
+        with open(filename, 'w') as f:
+            json.dump({'summary': self.summary(), 'images': self.images}, f,
+                      indent=2, sort_keys=True)
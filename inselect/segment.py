@@ -1,99 +1,472 @@
 import cv2
 import numpy as np
-from skimage.feature.blob import blob_log
 
+import ctypes
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
 
-def segment_blobs(image):
-    gray = cv2.cvtColor(image, cv2.cv.CV_BGR2GRAY)
-    blobs = blob_log(gray, min_sigma=0.001, max_sigma=5)
-    print blobs
+from .cache import cached, image_key
+from .timing import timed
+
+
+def _blob_octave(level, octave, sigmas, threshold, edge_ratio=10):
+    """Scale space extrema of one pyramid level.
+
+    Returns
+    -------
+    blobs : (K, 4) array
+        Blob centres and radii in full resolution pixels, and the DoG
+        response of each.
+
+    """
+    blurred = [cv2.GaussianBlur(level, (0, 0), sigma) for sigma in sigmas]
+    dogs = [fine - coarse for fine, coarse in zip(blurred, blurred[1:])]
+    peaks = [cv2.dilate(dog, np.ones((3, 3), np.uint8)) for dog in dogs]
+    factor = 2 ** octave
+    blobs = []
+    for i in range(1, len(dogs) - 1):
+        neighbours = np.maximum(np.maximum(peaks[i - 1], peaks[i + 1]),
+                                peaks[i])
+        ys, xs = np.nonzero((dogs[i] >= neighbours) & (dogs[i] > threshold))
+        ys, xs = _blob_peaks(dogs[i], ys, xs, edge_ratio)
+        radius = np.sqrt(2) * sigmas[i] * factor
+        blobs.append(np.column_stack([
+            (xs + 0.5) * factor, (ys + 0.5) * factor,
+            np.full(len(xs), radius), dogs[i][ys, xs]]))
+    return np.vstack(blobs)
+
+
+def _blob_peaks(dog, ys, xs, edge_ratio):
+    """Peaks of `dog` that are blobs rather than points on an edge.
+
+    As in SIFT, a peak is rejected when the ratio of the principal
+    curvatures of the DoG, from its Hessian, exceeds `edge_ratio`.
+
+    """
+    inner = ((ys > 0) & (xs > 0) &
+             (ys < dog.shape[0] - 1) & (xs < dog.shape[1] - 1))
+    ys, xs = ys[inner], xs[inner]
+    centre = dog[ys, xs]
+    dxx = dog[ys, xs + 1] + dog[ys, xs - 1] - 2 * centre
+    dyy = dog[ys + 1, xs] + dog[ys - 1, xs] - 2 * centre
+    dxy = (dog[ys + 1, xs + 1] - dog[ys + 1, xs - 1] -
+           dog[ys - 1, xs + 1] + dog[ys - 1, xs - 1]) / 4
+    trace, det = dxx + dyy, dxx * dyy - dxy ** 2
+    keep = (det > 0) & (trace ** 2 * edge_ratio <
+                        (edge_ratio + 1) ** 2 * det)
+    return ys[keep], xs[keep]
+
+
+def _prune_blobs(blobs):
+    """Drop blobs centred inside a stronger blob."""
+    blobs = blobs[np.argsort(-blobs[:, 3], kind='mergesort')]
+    keep = np.ones(len(blobs), bool)
+    for i in range(len(blobs)):
+        if keep[i]:
+            x, y, r = blobs[i, :3]
+            inside = ((blobs[i + 1:, 0] - x) ** 2 +
+                      (blobs[i + 1:, 1] - y) ** 2) < r ** 2
+            keep[i + 1:] &= ~inside
+    return blobs[keep]
+
+
+def segment_blobs(image, window=None, threshold=8, min_radius=8,
+                  max_radius=None, intervals=3, processes=None):
+    """Segments an image into dark, roughly round specimens.
+
+    Blobs are the scale space extrema of a Difference-of-Gaussians
+    pyramid.  Each octave is found on an image downsampled to the octave's
+    scale, so the cost of the large scales is small, and the octaves run
+    in a thread pool.
+
+    Parameters
+    ----------
+    image : (M, N, 3) or (M, N) array
+        Image to process, in BGR or grayscale.
+    window : tuple, (x, y, w, h)
+        Optional subwindow in image.
+    threshold : float
+        Least DoG response, in grey levels, of a blob.
+    min_radius, max_radius : float
+        Radii of the smallest and largest blobs, in pixels.  By default
+        the largest is an eighth of the shorter image side.
+    intervals : int
+        Scales per octave.
+    processes : int
+        Threads used for the octaves, by default one per CPU.
+
+    Returns:
+    --------
+    (rects, display) : list, (M, N) array
+        Region results and visualization image.
+
+    """
+    if window:
+        image, (x, y) = window_view(image, window)
+    height, width = image.shape[:2]
+    if max_radius is None:
+        max_radius = min(height, width) / 8.0
+
+    # Blobs of radius sqrt(2) * sigma, with sigma from base to twice base
+    # in each octave
+    base = 1.6
+    sigmas = [base * 2 ** (i / float(intervals))
+              for i in range(-1, intervals + 2)]
+    lowest = int(max(0, np.floor(np.log2(min_radius / (np.sqrt(2) * base)))))
+    highest = int(max(lowest, np.ceil(np.log2(max_radius /
+                                              (np.sqrt(2) * base)))))
+
+    # Dark specimens on a light background are bright blobs when inverted
+    gray = grayscale(image)
+    level = (255 - gray).astype(np.float32)
+    levels = []
+    for octave in range(highest + 1):
+        if octave >= lowest:
+            levels.append((level, octave))
+        if min(level.shape) < 16:
+            break
+        level = cv2.pyrDown(level)
+
+    pool = ThreadPool(processes)
+    try:
+        blobs = pool.map(lambda (level, octave): _blob_octave(
+            level, octave, sigmas, threshold), levels)
+    finally:
+        pool.close()
+    blobs = np.vstack(blobs or [np.zeros((0, 4))])
+    blobs = blobs[(blobs[:, 2] >= min_radius / np.sqrt(2)) &
+                  (blobs[:, 2] <= max_radius * np.sqrt(2))]
+    blobs = _prune_blobs(blobs)
+
+    display = np.zeros((height, width), np.uint8)
+    rects = []
+    for bx, by, r, _ in blobs:
+        cv2.circle(display, (int(bx), int(by)), int(r), 255, 1)
+        rect = _clip_rect((int(bx - r), int(by - r),
+                           int(2 * r), int(2 * r)), (0, 0, width, height))
+        if window:
+            rect = (rect[0] + x, rect[1] + y, rect[2], rect[3])
+        rects.append(rect)
+    return rects, display
 
 
 def right_sized(contour, image_size, size_filter=True):
-    x, y, w, h = cv2.boundingRect(contour)
+    return right_sized_rect(cv2.boundingRect(contour), image_size,
+                            size_filter=size_filter)
+
+
+def right_sized_rect(rect, image_size, size_filter=True):
+    return bool(right_sized_rects(np.array([rect]), image_size,
+                                  size_filter=size_filter)[0])
+
+
+def right_sized_rects(rects, image_size, size_filter=True):
+    """Vectorized `right_sized` test.
+
+    Parameters
+    ----------
+    rects : (K, 4) array
+        Rects as rows of (x, y, w, h).
+    image_size : tuple
+        Shape of the image the rects were found in.
+    size_filter : Boolean
+        Reject large objects.
+
+    Returns
+    -------
+    mask : (K,) bool array
+        Whether each rect is of the right size.
+
+    """
+    w = rects[:, 2].astype(np.float64)
+    h = rects[:, 3].astype(np.float64)
     area = image_size[0] * image_size[1]
-    if w > h:
-        ratio = float(w) / h
-    else:
-        ratio = float(h) / w
-    return ratio < 8 and w * h > area / 8E3 and \
-        not (size_filter and
-             (w > image_size[1] * 0.35 or h > image_size[0] * 0.35)) and \
-        not ((w == image_size[0]) and h == image_size[1])
+    ratio = np.maximum(w, h) / np.minimum(w, h)
+    mask = (ratio < 8) & (w * h > area / 8E3)
+    if size_filter:
+        mask &= ~((w > image_size[1] * 0.35) | (h > image_size[0] * 0.35))
+    return mask & ~((w == image_size[0]) & (h == image_size[1]))
+
+
+def contour_rects(contours):
+    """Bounding rects of all contours at once.
+
+    Returns
+    -------
+    rects : (K, 4) array
+        Same values as calling `cv2.boundingRect` on each contour.
+
+    """
+    if not len(contours):
+        return np.zeros((0, 4), np.int64)
+    points = np.concatenate(contours).reshape(-1, 2)
+    starts = np.cumsum([0] + [len(c) for c in contours[:-1]])
+    low = np.minimum.reduceat(points, starts)
+    high = np.maximum.reduceat(points, starts)
+    return np.hstack([low, high - low + 1]).astype(np.int64)
 
 
 def process_contours(image, contours, hierarchy, index=0, size_filter=True):
+    """Rects of the outermost right sized contours.
+
+    Contours that are not of the right size are replaced by their right
+    sized children.
+
+    """
+    if hierarchy is None or not len(contours):
+        return []
+    rects = contour_rects(contours)
+    accept = right_sized_rects(rects, image.shape, size_filter=size_filter)
+    rects = rects.tolist()
+    return [tuple(rects[i]) for i in
+            _walk_hierarchy(hierarchy[0], accept.tolist(), index)]
+
+
+def _walk_hierarchy(hierarchy, accept, index=0):
+    """Indices of accepted contours not nested in an accepted contour.
+
+    The hierarchy is walked depth first, in the order OpenCV lists the
+    siblings, without recursion.
+
+    """
+    next = hierarchy[:, 0].tolist()
+    child = hierarchy[:, 2].tolist()
     result = []
-    while index >= 0:
-        next, previous, child, parent = hierarchy[0][index]
-        if right_sized(contours[index], image.shape, size_filter=size_filter):
-            rect = cv2.boundingRect(contours[index])
-            x, y, w, h = rect
-            result.append(rect)
-        else:
-            if child != -1:
-                rects = process_contours(image, contours, hierarchy, child,
-                                         size_filter=size_filter)
-                result.extend(rects)
-        index = next
+    stack = [index]
+    while stack:
+        index = stack.pop()
+        while index >= 0:
+            if accept[index]:
+                result.append(index)
+            elif child[index] != -1:
+                stack.append(next[index])
+                index = child[index]
+                continue
+            index = next[index]
     return result
 
 
+def _box_sums(table, rects):
+    """Sum of the pixels in each rect, looked up in a summed-area table."""
+    x0, y0 = rects[:, 0], rects[:, 1]
+    x1, y1 = x0 + rects[:, 2], y0 + rects[:, 3]
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+def box_statistics(gray, rects, image=None, edges=None, tables=None):
+    """Per-box statistics computed from summed-area tables.
+
+    Each statistic costs O(1) per box once the tables are built, and all
+    boxes are handled in one array operation.
+
+    Parameters
+    ----------
+    gray : (M, N) array
+        Grayscale image.
+    rects : list of (x, y, w, h)
+        Boxes to describe.
+    image : (M, N, 3) array
+        Optional colour image, for the mean colour of each box.
+    edges : (M, N) array
+        Optional edge image, such as the thresholded gradient magnitude,
+        for the fraction of edge pixels in each box.
+    tables : tuple of arrays
+        Summed-area tables of `gray` and its square, as returned by
+        ``cv2.integral2(gray, sdepth=cv2.CV_64F)``, if already computed.
+
+    Returns
+    -------
+    stats : dict of arrays
+        ``mean`` and ``variance`` of the gray values, and ``colour`` and
+        ``edge_density`` when `image` and `edges` are given.
+
+    """
+    rects = np.asarray(rects, np.int64).reshape(-1, 4)
+    area = (rects[:, 2] * rects[:, 3]).astype(np.float64)
+    if tables is None:
+        tables = cv2.integral2(gray, sdepth=cv2.CV_64F)
+    total, squares = tables
+    mean = _box_sums(total, rects) / area
+    stats = {'mean': mean,
+             'variance': _box_sums(squares, rects) / area - mean ** 2}
+    if image is not None:
+        colour = cv2.integral(image, sdepth=cv2.CV_64F)
+        stats['colour'] = _box_sums(colour, rects) / area[:, None]
+    if edges is not None:
+        counts = cv2.integral((edges > 0).astype(np.uint8))
+        stats['edge_density'] = _box_sums(counts, rects) / area
+    return stats
+
+
+def grayscale(image, dst=None):
+    """Grayscale version of a BGR image.
+
+    Images that are already grayscale, such as those decoded with
+    ``cv2.IMREAD_GRAYSCALE``, are returned as they are.
+
+    """
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.cv.CV_BGR2GRAY, dst)
+
+
+def edge_magnitude(image, buffers=None, timer=None):
+    """Blurred grayscale image and its Sobel gradient magnitude.
+
+    First stage of `segment_edges`.  With a `BufferPool`, the results and
+    intermediate images are written to its buffers instead of new arrays,
+    so they are only valid until the pool is used again.  With a
+    `StageTimer`, the grayscale, blur, Sobel and magnitude steps are timed.
+
+    """
+    shape = image.shape[:2]
+
+    def buffer(name, dtype):
+        if buffers is not None:
+            return buffers.get(name, shape, dtype)
+
+    gray = timed(timer, 'grayscale', lambda: grayscale(
+        image, buffer('gray', np.uint8)))
+    gray = timed(timer, 'blur', lambda: cv2.GaussianBlur(
+        gray, (3, 3), 3, dst=buffer('blur', np.uint8)))
+    v_edges, h_edges = timed(timer, 'sobel', lambda: (
+        cv2.Sobel(gray, cv2.CV_32F, 1, 0, buffer('v_edges', np.float32), 1),
+        cv2.Sobel(gray, cv2.CV_32F, 0, 1, buffer('h_edges', np.float32), 1)))
+    mag = timed(timer, 'magnitude', lambda: cv2.magnitude(
+        v_edges, h_edges, buffer('mag', np.float32)))
+    return gray, mag
+
+
+def window_view(image, window):
+    """View of the (x, y, w, h) `window` of an image, without copying.
+
+    Returns
+    -------
+    (view, (x, y)) : array, tuple
+        The window contents and its integer offset in the image.
+
+    """
+    x, y, w, h = [int(v) for v in window]
+    x, y = max(0, x), max(0, y)
+    return image[y:y + h, x:x + w], (x, y)
+
+
+def threshold_magnitude(mag, threshold, max_mag=None, out=None):
+    """Binary edge image from a gradient magnitude.
+
+    The magnitude is scaled so that `max_mag`, by default its maximum,
+    maps to 255, truncated to uint8 and compared with `threshold`.  The
+    steps are fused into one comparison against the equivalent magnitude,
+    without intermediate images.  An image without any gradient has no
+    edges.
+
+    """
+    if max_mag is None:
+        max_mag = np.max(mag)
+    # A zero maximum would make every pixel an edge
+    limit = (threshold + 1) * (float(max_mag) or 1.0) / 255
+    return cv2.compare(mag, limit, cv2.CMP_GE, out)
+
+
+def find_contours(binary, out=None):
+    """Contour tree of a binary edge image, leaving the image untouched.
+
+    findContours modifies its input, so it works on a copy, made in `out`
+    if given.
+
+    """
+    if out is None:
+        out = binary.copy()
+    else:
+        out[...] = binary
+    return cv2.findContours(out,
+                            cv2.RETR_TREE,
+                            cv2.CHAIN_APPROX_SIMPLE)
+
+
 def segment_edges(image, window=None, threshold=12,
-                  variance_threshold=None, size_filter=True):
+                  variance_threshold=None, size_filter=True, cache=None,
+                  buffers=None, timer=None):
     """Segments an image based on edge intensities.
 
     Parameters
     ----------
-    image : (M, N, 3) array
-        Image to process.
+    image : (M, N, 3) or (M, N) array
+        Image to process, in BGR or grayscale.
     window : tuple, (x, y, w, h)
         Optional subwindow in image.
     variance_threshold : float
         Color variance limit for detected regions.
     size_filter: Boolean
         Reject large objects.
+    cache : StageCache
+        Optional cache of intermediate results.  Each stage is keyed by the
+        image content and the parameters it depends on, so a re-run with a
+        new `threshold` starts from the cached gradient magnitude.
+    buffers : BufferPool
+        Optional pool of working arrays, reused by calls on images of the
+        same shape.  Ignored when `cache` is given, since cached results
+        must not share memory.
+    timer : StageTimer
+        Optional timer, given a record for each stage that runs, with the
+        number of contours and of candidate and accepted rects.
 
     Returns:
     --------
     (rects, display) : list, (M, N, 3) array
         Region results and visualization image.
 
+    Notes
+    -----
+    The pipeline runs as `edge_magnitude`, `threshold_magnitude`,
+    `find_contours`, `process_contours` and, with `variance_threshold`,
+    a `box_statistics` filter.
+
     """
     if window:
-        subimage = np.array(image)
-        x, y, w, h = window
-        image = subimage[y:y + h, x:x + w]
+        image, (x, y) = window_view(image, window)
 
-    gray = cv2.cvtColor(image, cv2.cv.CV_BGR2GRAY)
-    gray = cv2.GaussianBlur(gray, (3, 3), 3)
-    display = gray.copy()
-    v_edges = cv2.Sobel(gray, cv2.CV_32F, 1, 0, None, 1)
-    h_edges = cv2.Sobel(gray, cv2.CV_32F, 0, 1, None, 1)
-    mag = np.sqrt(v_edges ** 2 + h_edges ** 2)
-    mag2 = (255*mag/np.max(mag)).astype(np.uint8)
-    _, mag2 = cv2.threshold(mag2, threshold, 255, cv2.cv.CV_THRESH_BINARY)
-    display = mag2.copy()
-
-    contours, hierarchy = cv2.findContours(mag2.copy(),
-                                           cv2.RETR_TREE,
-                                           cv2.CHAIN_APPROX_SIMPLE)
+    key = None
+    if cache is not None:
+        key = image_key(image)
+        buffers = None
 
-    contour_areas = [(cv2.contourArea(contour), contour)
-                     for contour in contours]
-    contour_areas.sort(lambda a, b: cmp(b[0], a[0]))
-    _, mag2 = cv2.threshold(v_edges, 5, 255, cv2.cv.CV_THRESH_BINARY)
-    mag2 = (255*mag2/np.max(mag2)).astype(np.uint8)
+    def buffer(name, dtype):
+        if buffers is not None:
+            return buffers.get(name, image.shape[:2], dtype)
 
-    rects = process_contours(display, contours, hierarchy,
-                             size_filter=size_filter)
-    if variance_threshold:
-        new_rects = []
-        for rect in rects:
-            im = gray[rect[1]:rect[1]+rect[3], rect[0]:rect[0]+rect[2]]
-            if np.var(im) > variance_threshold:
-                new_rects.append(rect)
-        rects = new_rects
+    gray, mag = cached(cache, ('edges', key),
+                       lambda: edge_magnitude(image, buffers, timer))
+    mag2 = cached(cache, ('threshold', key, threshold),
+                  lambda: timed(timer, 'threshold',
+                                lambda: threshold_magnitude(
+                                    mag, threshold,
+                                    out=buffer('binary', np.uint8))))
+    if cache is None and buffers is None:
+        display = mag2
+    else:
+        display = mag2.copy()
+    contours, hierarchy = cached(
+        cache, ('contours', key, threshold),
+        lambda: timed(timer, 'contours', lambda: find_contours(
+            mag2, buffer('contours', np.uint8)),
+            lambda (contours, _): {'contours': len(contours)}))
+    rects_key = (key, threshold, bool(size_filter))
+    rects = cached(cache, ('rects',) + rects_key,
+                   lambda: timed(timer, 'rects', lambda: process_contours(
+                       mag2, contours, hierarchy, size_filter=size_filter),
+                       lambda rects: {'rects': len(rects)}))
+    if variance_threshold and rects:
+        def filter_rects(rects):
+            variance = cached(cache, ('variance',) + rects_key,
+                              lambda: box_statistics(gray, rects)['variance'])
+            return [rect for rect, keep in
+                    zip(rects, variance > variance_threshold) if keep]
+
+        rects = timed(timer, 'variance', lambda: filter_rects(rects),
+                      lambda kept: {'candidates': len(rects),
+                                    'rects': len(kept)})
     if window:
         new_rects = []
         for rect in rects:
@@ -101,23 +474,824 @@ def segment_edges(image, window=None, threshold=12,
             new_rects.append(new_rect)
         rects = new_rects
 
-    # return rects
+    return rects, display
+
+
+def filter_variance(image, rects, variance_threshold):
+    """Keep rects whose blurred grayscale content varies enough.
+
+    Each rect is converted and blurred with a one pixel border so that the
+    result matches the filter applied on the full image in `segment_edges`.
+
+    """
+    height, width = image.shape[:2]
+    result = []
+    for rect in rects:
+        x, y, w, h = rect
+        x0, y0 = max(0, x - 1), max(0, y - 1)
+        x1, y1 = min(width, x + w + 1), min(height, y + h + 1)
+        gray = grayscale(image[y0:y1, x0:x1])
+        gray = cv2.GaussianBlur(gray, (3, 3), 3)
+        if np.var(gray[y - y0:y - y0 + h, x - x0:x - x0 + w]) > \
+                variance_threshold:
+            result.append(rect)
+    return result
+
+
+def _tile_windows(shape, tile_size, overlap):
+    """Split an image into tiles padded by `overlap` pixels.
+
+    Returns
+    -------
+    windows : list of ((x, y, w, h), (x, y, w, h))
+        Padded tile window and the unpadded core it is responsible for.
+
+    """
+    height, width = shape[:2]
+    windows = []
+    for cy in range(0, height, tile_size):
+        for cx in range(0, width, tile_size):
+            cw = min(tile_size, width - cx)
+            ch = min(tile_size, height - cy)
+            tx, ty = max(0, cx - overlap), max(0, cy - overlap)
+            tw = min(width, cx + cw + overlap) - tx
+            th = min(height, cy + ch + overlap) - ty
+            windows.append(((tx, ty, tw, th), (cx, cy, cw, ch)))
+    return windows
+
+
+def _on_seam(rect, tile, shape, margin=2):
+    """Whether `rect` (image coordinates) reaches an interior tile edge.
+
+    Contours that come within `margin` of an interior edge may continue in
+    the neighbouring tile, so their bounding rect cannot be trusted.
+
+    """
+    return bool(_on_seam_rects(np.array([rect]), tile, shape, margin)[0])
+
+
+def _on_seam_rects(rects, tile, shape, margin=2):
+    """Vectorized `_on_seam` for a (K, 4) array of rects."""
+    x, y, w, h = rects.T
+    tx, ty, tw, th = tile
+    height, width = shape[:2]
+    return (((tx > 0) & (x < tx + margin)) |
+            ((ty > 0) & (y < ty + margin)) |
+            ((tx + tw < width) & (x + w > tx + tw - margin)) |
+            ((ty + th < height) & (y + h > ty + th - margin)))
+
+
+def _clip_rect(rect, window):
+    x, y, w, h = rect
+    wx, wy, ww, wh = window
+    x0, y0 = max(x, wx), max(y, wy)
+    x1, y1 = min(x + w, wx + ww), min(y + h, wy + wh)
+    return (x0, y0, max(0, x1 - x0), max(0, y1 - y0))
+
+
+# Image, gradient magnitude and display shared with the tile workers
+_tile_buffers = {}
+
+
+def _init_tile_worker(image, mag, display, shape):
+    _tile_buffers['image'] = np.ctypeslib.as_array(image).reshape(shape)
+    _tile_buffers['mag'] = np.ctypeslib.as_array(mag).reshape(shape[:2])
+    _tile_buffers['display'] = \
+        np.ctypeslib.as_array(display).reshape(shape[:2])
+
+
+def _tile_edges(core):
+    """Store the gradient magnitude of a tile core and return its maximum.
+
+    The core is padded by two pixels so that the blur and Sobel kernels
+    give the same values as on the full image.
+
+    """
+    image = _tile_buffers['image']
+    cx, cy, cw, ch = core
+    tx, ty, tw, th = _clip_rect((cx - 2, cy - 2, cw + 4, ch + 4),
+                                (0, 0, image.shape[1], image.shape[0]))
+    _, mag = edge_magnitude(image[ty:ty + th, tx:tx + tw])
+    mag = mag[cy - ty:cy - ty + ch, cx - tx:cx - tx + cw]
+    _tile_buffers['mag'][cy:cy + ch, cx:cx + cw] = mag
+    return float(np.max(mag))
+
+
+def _segment_tile(args):
+    """Segment one tile against the full image's magnitude maximum."""
+    window, core, shape, threshold, size_filter, max_mag, band = args
+    tx, ty, tw, th = window
+    mag = _tile_buffers['mag'][ty:ty + th, tx:tx + tw]
+    mag2 = threshold_magnitude(mag, threshold, max_mag)
+    cx, cy, cw, ch = core
+    _tile_buffers['display'][cy:cy + ch, cx:cx + cw] = \
+        mag2[cy - ty:cy - ty + ch, cx - tx:cx - tx + cw]
+    return _tile_contours(mag2, window, shape, size_filter, band)
+
+
+def _tile_pieces(binary, window, margin=2):
+    """Label the pieces of a tile that come near its border.
+
+    Pieces are the connected parts of the foreground, 8-connected, and of
+    the background, 4-connected, that lie inside the tile, the way
+    findContours sees them.  Every piece that the tile cannot see whole
+    has a pixel within `margin` + 1 of the tile border, so only those are
+    flood filled, in a float32 copy of `binary`.  The k-th piece filled is
+    labelled 255 + k if it is background and -k if it is foreground.
+
+    Returns
+    -------
+    (labels, pieces) : (M, N) float32 array, dict
+        The labelled copy, and for each label the bounding rect of its
+        pixels, its first pixel in raster order and the label of the pixel
+        left of it, all in image coordinates.  That label is 0 for the
+        outside of the image and None if the pixel is not in the tile.
+
+    """
+    tx, ty, tw, th = window
+    labels = binary.astype(np.float32)
+    depth = margin + 1
+    lines = [(labels[y], y, None) for y in
+             sorted(set(range(min(depth, th))) |
+                    set(range(max(0, th - depth), th)))]
+    lines += [(labels[:, x], None, x) for x in
+              sorted(set(range(min(depth, tw))) |
+                     set(range(max(0, tw - depth), tw)))]
+    # Neighbouring pixels of a line that are alike are in the same piece,
+    # so each run of the line needs one seed at most
+    seeds = []
+    for line, y, x in lines:
+        starts = np.flatnonzero(np.concatenate(
+            ([True], line[1:] != line[:-1]))).tolist()
+        seeds.extend((y, start) if x is None else (start, x)
+                     for start in starts)
+
+    filled = []
+    for y, x in seeds:
+        value = labels[y, x]
+        if value != 0 and value != 255:
+            continue
+        if value:
+            code, connectivity = -len(filled) - 1, 8
+        else:
+            code, connectivity = 256 + len(filled), 4
+        rect = cv2.floodFill(labels, None, (x, y), code, 0, 0,
+                             connectivity)[-1]
+        filled.append((code, tuple(rect)))
+
+    pieces = {}
+    for code, (x, y, w, h) in filled:
+        first = x + int(np.argmax(labels[y, x:x + w] == code))
+        if first > 0:
+            left = labels[y, first - 1]
+            left = int(left) if left < 0 or left > 255 else None
+        else:
+            left = 0 if tx == 0 else None
+        pieces[code] = ((x + tx, y + ty, w, h), (y + ty, first + tx), left)
+    return labels, pieces
+
+
+def _tile_contours(mag2, window, shape, size_filter, band):
+    """Contours of a thresholded tile, and the pieces it cannot see whole.
+
+    findContours may modify `mag2`, which is not used afterwards.
+
+    Returns
+    -------
+    rects : list of ((x, y, w, h), label)
+        Right sized rects that lie safely inside the tile and are not
+        nested in a right sized contour that does, each with the label of
+        the piece of `_tile_pieces` around the outermost such contour
+        that it is nested in.
+    pieces : dict
+        Pieces that reach near the tile border, as returned by
+        `_tile_pieces`.
+    bands : list of ((x, y, w, h), array)
+        Labels of those pieces along the tile border, used to stitch them
+        across seams.
+
+    """
+    tx, ty, tw, th = window
+    labels, pieces = _tile_pieces(mag2, window)
+    band_w, band_h = min(band, tw), min(band, th)
+    bands = [((tx, ty, tw, band_h), labels[:band_h]),
+             ((tx, ty + th - band_h, tw, band_h), labels[th - band_h:]),
+             ((tx, ty, band_w, th), labels[:, :band_w]),
+             ((tx + tw - band_w, ty, band_w, th), labels[:, tw - band_w:])]
+    bands = [(region, np.where((values < 0) | (values > 255),
+                               values, 0).astype(np.int32))
+             for region, values in bands]
+    contours, hierarchy = cv2.findContours(mag2,
+                                           cv2.RETR_TREE,
+                                           cv2.CHAIN_APPROX_SIMPLE)
+    rects = []
+    if hierarchy is None:
+        return rects, pieces, bands
+    boxes = contour_rects(contours) + [tx, ty, 0, 0]
+    seam = _on_seam_rects(boxes, window, shape).tolist()
+    accept = right_sized_rects(boxes, shape, size_filter=size_filter)
+    accept = accept.tolist()
+    boxes = [tuple(box) for box in boxes.tolist()]
+    next = hierarchy[0][:, 0].tolist()
+    child = hierarchy[0][:, 2].tolist()
+    parent = hierarchy[0][:, 3].tolist()
+
+    def piece(index, depth):
+        # Outermost ancestor that the tile sees whole
+        while parent[index] != -1 and not seam[parent[index]]:
+            index, depth = parent[index], depth - 1
+        # The first point of an outer contour is the first pixel of its
+        # component, and the pixel left of it is in the background around
+        # the component.  A hole is in the component it is a hole of.
+        if depth % 2 == 0:
+            x, y = contours[index][0][0]
+            if x == 0:
+                return 0 if tx == 0 else None
+            value = labels[y, x - 1]
+        else:
+            x, y = contours[parent[index]][0][0]
+            value = labels[y, x]
+        return int(value) if value < 0 or value > 255 else None
+
+    # Walk the hierarchy like process_contours, but descend into the
+    # contours that reach a seam, since those may be nested in a contour
+    # that only the neighbouring tiles see.
+    stack = [(0, 0)]
+    while stack:
+        index, depth = stack.pop()
+        while index >= 0:
+            if accept[index] and not seam[index]:
+                rects.append((boxes[index], piece(index, depth)))
+            elif child[index] != -1:
+                stack.append((child[index], depth + 1))
+            index = next[index]
+    return rects, pieces, bands
+
+
+def _band_labels(bands, region):
+    x, y, w, h = region
+    for (bx, by, bw, bh), labels in bands:
+        if _contains((bx, by, bw, bh), region):
+            return labels[y - by:y - by + h, x - bx:x - bx + w]
+
+
+def _find(parent, key):
+    while parent.get(key, key) != key:
+        key = parent[key]
+    return key
+
+
+def _link_tiles(parent, i, a, bands_a, j, b, bands_b):
+    """Join the pieces of tiles `i` and `j` that share a pixel.
+
+    A pixel of two pieces is in the same connected component of the
+    image, so pieces are stitched wherever both tiles labelled the same
+    pixel of their overlap.  `parent` is a union-find forest over
+    (tile index, label) keys.
+
+    """
+    region = _clip_rect(a, b)
+    if not region[2] or not region[3]:
+        return
+    la = _band_labels(bands_a, region)
+    lb = _band_labels(bands_b, region)
+    both = (la != 0) & (lb != 0)
+    pairs = np.unique((la[both].astype(np.int64) << 32) |
+                      (lb[both].astype(np.int64) & 0xffffffff))
+    for pair in pairs.tolist():
+        label_a, label_b = pair >> 32, pair & 0xffffffff
+        root_a = _find(parent, (i, label_a))
+        root_b = _find(parent, (j, label_b - (label_b >> 31 << 32)))
+        if root_a != root_b:
+            parent[root_a] = root_b
+
+
+def _contains(outer, inner):
+    x, y, w, h = inner
+    ox, oy, ow, oh = outer
+    return ox <= x and oy <= y and x + w <= ox + ow and y + h <= oy + oh
+
+
+def _stitched_contours(pieces, parent, shape, size_filter, seen_by):
+    """Contours of the image that no tile sees whole.
+
+    Each is a connected component, of the foreground or of the background
+    inside it, assembled from the pieces of `_tile_pieces`.  Its contour
+    has the bounding rect of its pixels, widened by one pixel for the
+    background, and its parent in the contour tree is the component left
+    of its first pixel in raster order.
+
+    Returns
+    -------
+    contours : dict
+        (rect, parent, accepted) for the root key of each contour, and
+        None for the background around the image.
+
+    """
+    height, width = shape[:2]
+    groups = {}
+    for i, tile_pieces in enumerate(pieces):
+        for label, (rect, first, left) in tile_pieces.items():
+            groups.setdefault(_find(parent, (i, label)), []).append(
+                (first, rect, None if left is None else (i, left)))
+
+    contours = {}
+    for key, members in groups.items():
+        x0 = min(rect[0] for _, rect, _ in members)
+        y0 = min(rect[1] for _, rect, _ in members)
+        x1 = max(rect[0] + rect[2] for _, rect, _ in members)
+        y1 = max(rect[1] + rect[3] for _, rect, _ in members)
+        if key[1] > 0:
+            if x0 == 0 or y0 == 0 or x1 == width or y1 == height:
+                contours[key] = None
+                continue
+            x0, y0, x1, y1 = x0 - 1, y0 - 1, x1 + 1, y1 + 1
+        rect = (x0, y0, x1 - x0, y1 - y0)
+        if seen_by(rect):
+            continue
+        first = min(member[0] for member in members)
+        lefts = [left for member, _, left in members
+                 if member == first and left is not None]
+        left = lefts[0] if lefts else None
+        if left is not None:
+            left = 0 if left[1] == 0 else _find(parent, left)
+        contours[key] = (rect, left, right_sized_rect(
+            rect, shape, size_filter=size_filter))
+    return contours
+
+
+def _combine_tiles(tiles, rects, pieces, parent, shape, size_filter):
+    """Rects of the whole image from the rects and pieces of its tiles.
+
+    A rect is kept only if every tile that sees all of it found it, since
+    a tile that drops it has seen the contour it is nested in, and if no
+    contour that it is nested in and that no tile sees whole is accepted.
+    Those contours are assembled from the stitched pieces, and are
+    results themselves when accepted and not nested in another.
+
+    """
+    def seen_by(rect):
+        return [i for i, tile in enumerate(tiles)
+                if _contains(tile, rect) and not _on_seam(rect, tile, shape)]
+
+    contours = _stitched_contours(pieces, parent, shape, size_filter,
+                                  seen_by)
+    hidden = {}
+
+    def nested(key):
+        """Whether `key`, or a contour it is nested in, is an accepted
+        stitched contour."""
+        chain = []
+        while contours.get(key) is not None and key not in hidden:
+            chain.append(key)
+            key = contours[key][1]
+        result = hidden.get(key, False)
+        for key in reversed(chain):
+            result = result or contours[key][2]
+            hidden[key] = result
+        return result
+
+    found = {}
+    for index, tile_rects in enumerate(rects):
+        for rect, label in tile_rects:
+            key = None if label is None else \
+                0 if label == 0 else _find(parent, (index, label))
+            found.setdefault(rect, {}).setdefault(index, []).append(key)
+    result = []
+    for rect, tiles_found in found.items():
+        tiles_seen = seen_by(rect)
+        if all(i in tiles_found for i in tiles_seen) and \
+                not any(nested(key) for keys in tiles_found.values()
+                        for key in keys):
+            result.append(rect)
+    for key, contour in contours.items():
+        if contour is not None and contour[2] and not nested(contour[1]):
+            result.append(contour[0])
+    return sorted(result)
+
+
+def segment_edges_tiled(image, window=None, threshold=12,
+                        variance_threshold=None, size_filter=True,
+                        tile_size=2048, overlap=128, processes=None):
+    """Segment a large image in overlapping tiles using a process pool.
+
+    Takes the same parameters and returns the same results as
+    `segment_edges`, so it can be used as a drop-in replacement.  Contours
+    that cross a tile seam are reassembled from the connected pieces that
+    each tile labels near its border, so that they nest as they do in the
+    whole image.
+
+    Parameters
+    ----------
+    tile_size : int
+        Side of the region each tile is responsible for.
+    overlap : int
+        Padding around each tile.  Contours that reach past it are stitched
+        from the fragments found in each tile.
+    processes : int
+        Size of the worker pool.  Defaults to the number of CPUs; with
+        ``processes=1`` tiles are processed in this process.
+
+    Notes
+    -----
+    Results are as exact as OpenCV's contour tree.  In images with tens of
+    thousands of contours findContours can nest a contour in one that does
+    not hold it, and the whole image and its tiles need not misplace the
+    same contours.
+
+    """
+    if window:
+        image, (x, y) = window_view(image, window)
+    shape = image.shape
+    windows = _tile_windows(shape, tile_size, overlap)
+
+    tiles = [tile for tile, core in windows]
+    if processes == 1:
+        # Tiles processed here work on the image itself
+        pool = None
+        mapper = map
+        display = np.empty(shape[:2], np.uint8)
+        _tile_buffers.update(image=image, display=display,
+                             mag=np.empty(shape[:2], np.float32))
+    else:
+        buffers = (RawArray(ctypes.c_uint8, image.size),
+                   RawArray(ctypes.c_float, shape[0] * shape[1]),
+                   RawArray(ctypes.c_uint8, shape[0] * shape[1]),
+                   shape)
+        np.ctypeslib.as_array(buffers[0]).reshape(shape)[:] = image
+        display = np.ctypeslib.as_array(buffers[2]).reshape(shape[:2])
+        pool = Pool(processes, _init_tile_worker, buffers)
+        mapper = pool.map
+    try:
+        # The magnitude is normalised by its maximum over the whole image,
+        # so every tile core is computed before any tile is thresholded.
+        max_mag = max(mapper(_tile_edges, [core for tile, core in windows]))
+        results = mapper(_segment_tile, [
+            (tile, core, shape, threshold, size_filter, max_mag,
+             2 * overlap)
+            for tile, core in windows])
+    finally:
+        _tile_buffers.clear()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    parent = {}
+    for i, a in enumerate(tiles):
+        for j in range(i + 1, len(tiles)):
+            _link_tiles(parent, i, a, results[i][2], j, tiles[j],
+                        results[j][2])
+    rects = _combine_tiles(tiles, [r[0] for r in results],
+                           [r[1] for r in results], parent, shape,
+                           size_filter)
+
+    if variance_threshold:
+        rects = filter_variance(image, rects, variance_threshold)
+    if window:
+        rects = [(rect[0] + x, rect[1] + y, rect[2], rect[3])
+                 for rect in rects]
+    return rects, display
+
+
+def _strip_windows(shape, rows, overlap):
+    """Split an image into full width strips padded by `overlap` rows.
+
+    Returns
+    -------
+    windows : list of ((x, y, w, h), (x, y, w, h))
+        Padded strip window and the unpadded core it is responsible for.
+
+    """
+    height, width = shape[:2]
+    windows = []
+    for cy in range(0, height, rows):
+        ch = min(rows, height - cy)
+        ty = max(0, cy - overlap)
+        th = min(height, cy + ch + overlap) - ty
+        windows.append(((0, ty, width, th), (0, cy, width, ch)))
+    return windows
+
+
+def _strip_edges(source, y, h):
+    """Gradient magnitude of rows y to y + h of `source`, read with two
+    rows of padding so that it matches the full image.
+
+    """
+    y0 = max(0, y - 2)
+    y1 = min(source.shape[0], y + h + 2)
+    _, mag = edge_magnitude(np.asarray(source[y0:y1]))
+    return mag[y - y0:y - y0 + h]
+
+
+def segment_edges_streaming(source, threshold=12, variance_threshold=None,
+                            size_filter=True, max_memory=2 ** 29,
+                            overlap=64, keep_display=False):
+    """Segment an image strip by strip within a memory budget.
+
+    The image is read in full width horizontal strips, so it can be a
+    memory mapped array, e.g. from ``np.load(filename, mmap_mode='r')``,
+    that is much larger than the available memory.  Contours that cross
+    strip boundaries are stitched as in `segment_edges_tiled`, and the
+    rects are the same as those of `segment_edges`, within the limits
+    noted there.
+
+    The source is read twice: once to find the maximum gradient magnitude,
+    which every strip is normalised by, and once to segment.
+
+    Parameters
+    ----------
+    source : (M, N, 3) array-like
+        Image to process.  Only needs `shape` and slicing by rows.
+    max_memory : int
+        Approximate peak memory, in bytes, for the working arrays of a
+        strip, which sets the strip height.
+    overlap : int
+        Rows shared by neighbouring strips.
+    keep_display : bool
+        Also assemble the full size visualization image, which adds one
+        byte per pixel to the memory used.
+
+    Returns
+    -------
+    (rects, display) : list, (M, N) array or None
+        Region results, and the visualization image if `keep_display`.
+
+    """
+    shape = source.shape
+    width = shape[1]
+    # Working arrays of a strip take about 20 bytes per pixel: the source
+    # rows, gray and blurred images, the two float32 Sobel images and the
+    # magnitude while the gradient is computed, then the magnitude, the
+    # thresholded image, the copy findContours works on and the float32
+    # piece labels, of which the bands shared with the neighbouring strips
+    # are kept.
+    rows = max(4 * overlap, max_memory // (20 * width) - 2 * overlap)
+    windows = _strip_windows(shape, rows, overlap)
+    strips = [strip for strip, core in windows]
+
+    max_mag = max(np.max(_strip_edges(source, cy, ch))
+                  for _, (cx, cy, cw, ch) in windows)
+
+    display = np.zeros(shape[:2], np.uint8) if keep_display else None
+    rects, pieces, parent = [], [], {}
+    previous = None
+    for index, ((tx, ty, tw, th), (cx, cy, cw, ch)) in enumerate(windows):
+        mag2 = threshold_magnitude(_strip_edges(source, ty, th), threshold,
+                                   max_mag)
+        if keep_display:
+            display[cy:cy + ch] = mag2[cy - ty:cy - ty + ch]
+        strip_rects, strip_pieces, bands = _tile_contours(
+            mag2, strips[index], shape, size_filter, 2 * overlap)
+        del mag2
+        # Only neighbouring strips overlap, so their labels can be
+        # stitched and dropped as the strips go by.
+        if previous is not None:
+            _link_tiles(parent, index - 1, strips[index - 1], previous,
+                        index, strips[index], bands)
+        previous = bands[1:2]
+        rects.append(strip_rects)
+        pieces.append(strip_pieces)
+
+    rects = _combine_tiles(strips, rects, pieces, parent, shape,
+                           size_filter)
+
+    if variance_threshold:
+        kept = []
+        for rect in rects:
+            x, y, w, h = rect
+            x0, y0 = max(0, x - 1), max(0, y - 1)
+            crop = np.asarray(source[y0:y + h + 1, x0:x + w + 1])
+            if filter_variance(crop, [(x - x0, y - y0, w, h)],
+                               variance_threshold):
+                kept.append(rect)
+        rects = kept
+    return rects, display
+
+
+def _scale_rect(rect, factor):
+    """Smallest integer rect covering `rect` scaled by `factor`."""
+    x, y, w, h = rect
+    x0, y0 = int(np.floor(x * factor)), int(np.floor(y * factor))
+    x1, y1 = int(np.ceil((x + w) * factor)), int(np.ceil((y + h) * factor))
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def _block_runs(blocks):
+    """Runs of set blocks along each row of a block mask.
+
+    Returns
+    -------
+    runs : list of (row, start, stop)
+        Block row and the range of block columns of each run.
+
+    """
+    runs = []
+    for row in range(blocks.shape[0]):
+        columns = np.flatnonzero(blocks[row])
+        if len(columns):
+            breaks = np.flatnonzero(np.diff(columns) > 1)
+            starts = np.r_[columns[0], columns[breaks + 1]]
+            stops = np.r_[columns[breaks], columns[-1]] + 1
+            runs.extend((row, start, stop)
+                        for start, stop in zip(starts, stops))
+    return runs
+
+
+def _mark_blocks(blocks, rect, block):
+    x, y, w, h = rect
+    blocks[max(0, y // block):(y + h - 1) // block + 1,
+           max(0, x // block):(x + w - 1) // block + 1] = True
+
+
+def _cut_contours(contours, done, block):
+    """Which contours reach the border of the computed blocks.
+
+    Pixels outside the computed blocks are empty, so a contour that
+    reaches a block next to one that was not computed may continue past
+    it.  The vertices of a contour include its pixels on that border.
+
+    """
+    lengths = [len(contour) for contour in contours]
+    points = np.concatenate(contours).reshape(-1, 2)
+    bx, by = points[:, 0] // block, points[:, 1] // block
+    left, top = points[:, 0] % block == 0, points[:, 1] % block == 0
+    right = points[:, 0] % block == block - 1
+    bottom = points[:, 1] % block == block - 1
+    # Blocks outside the image count as computed, so that the image
+    # border is not taken for a cut
+    computed = np.pad(done, 1, 'constant', constant_values=True)
+
+    def missing(dx, dy):
+        return ~computed[by + 1 + dy, bx + 1 + dx]
+
+    cut = ((left & missing(-1, 0)) | (right & missing(1, 0)) |
+           (top & missing(0, -1)) | (bottom & missing(0, 1)) |
+           (left & top & missing(-1, -1)) | (right & top & missing(1, -1)) |
+           (left & bottom & missing(-1, 1)) |
+           (right & bottom & missing(1, 1)))
+    starts = np.cumsum([0] + lengths[:-1])
+    return np.logical_or.reduceat(cut, starts)
+
+
+def _overlapping(rects, others):
+    """Whether each of `rects` overlaps any of `others`, as (K, 4) arrays."""
+    if not len(others):
+        return np.zeros(len(rects), bool)
+    x, y, w, h = [v[:, None] for v in rects.T]
+    ox, oy, ow, oh = others.T
+    return ((x < ox + ow) & (ox < x + w) &
+            (y < oy + oh) & (oy < y + h)).any(axis=1)
+
+
+def _rects_agree(a, b, tolerance):
+    return len(a) == len(b) and all(
+        any(max(abs(p - q) for p, q in zip(r, s)) <= tolerance for s in b)
+        for r in a)
+
+
+def segment_edges_pyramid(image, window=None, threshold=12,
+                          variance_threshold=None, size_filter=True,
+                          scale=0.25, tolerance=None, max_grow=3, block=64):
+    """Segment candidates on a downsampled image and refine them.
+
+    Candidate regions are found on the image scaled by `scale`.  The
+    edges are then thresholded at full resolution only in the `block`
+    sized blocks that cover a candidate, and contours are traced once over
+    all of them, as `segment_edges` would on the whole image.
+    Takes the same parameters and returns the same results as
+    `segment_edges`, for the objects found at the lower scale.
+
+    Parameters
+    ----------
+    scale : float
+        Scale of the image used to find candidates.
+    tolerance : int
+        When given, refinement stops as soon as the boxes move by at most
+        this many pixels from one growth step to the next, even if some of
+        them still reach past the computed blocks.  The boxes may then
+        differ from those of `segment_edges`.
+    max_grow : int
+        Number of times the computed blocks may be grown around contours
+        that reach past them.
+    block : int
+        Side of the blocks the full resolution work is done in.
+
+    Notes
+    -----
+    Edge magnitudes are normalised by their maximum over the full image,
+    as in `segment_edges`, so the gradient is computed everywhere; only
+    the thresholding and contour tracing are restricted to the blocks.  The work saved grows with the share of the image that no
+    candidate covers, so it is largest on sparse trays.
+
+    """
+    if window:
+        image, (x, y) = window_view(image, window)
+    gray = grayscale(image)
+    height, width = gray.shape
+    bounds = (0, 0, width, height)
+
+    small = cv2.resize(gray, (max(1, int(width * scale)),
+                              max(1, int(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    _, small_mag = edge_magnitude(small)
+    small2 = threshold_magnitude(small_mag, threshold)
+    contours, hierarchy = find_contours(small2)
+    candidates = process_contours(small2, contours, hierarchy,
+                                  size_filter=size_filter)
+
+    # The normalisation needs the maximum over the whole image, so the
+    # gradient is computed strip by strip everywhere; the contours, the
+    # costliest part, are only traced in the blocks.
+    mag = np.empty((height, width), np.float32)
+    for y in range(0, height, block):
+        mag[y:y + block] = _strip_edges(gray, y, min(block, height - y))
+    max_mag = np.max(mag)
+
+    margin = int(np.ceil(1 / scale)) + 2
+    wanted = np.zeros((-(-height // block), -(-width // block)), bool)
+    for rect in candidates:
+        rect = _scale_rect(rect, 1 / scale)
+        _mark_blocks(wanted, (rect[0] - margin, rect[1] - margin,
+                              rect[2] + 2 * margin, rect[3] + 2 * margin),
+                     block)
+    done = np.zeros_like(wanted)
+    runs, rects, previous = [], [], None
+    for attempt in range(max_grow + 1):
+        for row, start, stop in _block_runs(wanted & ~done):
+            run = _clip_rect((start * block, row * block,
+                              (stop - start) * block, block), bounds)
+            runs.append(run)
+        done |= wanted
+        # Built anew on each pass, so findContours may modify it
+        mag2 = np.zeros((height, width), np.uint8)
+        for run in runs:
+            window_view(mag2, run)[0][...] = threshold_magnitude(
+                window_view(mag, run)[0], threshold, max_mag)
+        contours, hierarchy = cv2.findContours(mag2,
+                                               cv2.RETR_TREE,
+                                               cv2.CHAIN_APPROX_SIMPLE)
+        rects = process_contours(mag2, contours, hierarchy,
+                                 size_filter=size_filter)
+        if not rects or attempt == max_grow or (
+                tolerance is not None and previous is not None and
+                _rects_agree(rects, previous, tolerance)):
+            break
+        previous = rects
+        # Contours cut by the computed blocks may be larger, or enclose
+        # what was found inside them; compute the blocks around those
+        # that touch a result.
+        boxes = contour_rects(contours)
+        cut = _cut_contours(contours, done, block)
+        cut &= _overlapping(boxes, np.array(rects))
+        if not cut.any():
+            break
+        for box in boxes[cut].tolist():
+            _mark_blocks(wanted, (box[0] - block, box[1] - block,
+                                  box[2] + 2 * block, box[3] + 2 * block),
+                         block)
+
+    display = cv2.resize(small2, (width, height),
+                         interpolation=cv2.INTER_NEAREST)
+    for run in runs:
+        window_view(display, run)[0][...] = threshold_magnitude(
+            window_view(mag, run)[0], threshold, max_mag)
+
+    if variance_threshold:
+        rects = filter_variance(image, rects, variance_threshold)
+    if window:
+        rects = [(rect[0] + x, rect[1] + y, rect[2], rect[3])
+                 for rect in rects]
     return rects, display
 
 
 def segment_intensity(image, window=None):
     if window:
-        subimage = np.array(image)
-        x, y, w, h = window
-        image = subimage[y:y + h, x:x + w]
-    gray = cv2.cvtColor(image, cv2.cv.CV_BGR2GRAY)
+        image, (x, y) = window_view(image, window)
+    threshold = _dark_regions(image)
+    if window:
+        return _intensity_rects(threshold, (x, y))
+    return _intensity_rects(threshold)
+
+
+def _dark_regions(image):
+    gray = grayscale(image)
     gray = cv2.GaussianBlur(gray, (25, 25), 9)
-    threshold = 255 * (gray < 150).astype(np.uint8)
+    return 255 * (gray < 150).astype(np.uint8)
+
+
+def _intensity_rects(threshold, offset=None):
+    """Rects around the dark regions of `threshold`.
+
+    Rects found in a window at `offset` are grown by half their size on
+    each side, as a window usually holds a single specimen.
+
+    """
     contours, hierarchy = cv2.findContours(threshold.copy(),
                                            cv2.RETR_EXTERNAL,
                                            cv2.CHAIN_APPROX_SIMPLE)
     rects = [cv2.boundingRect(c) for c in contours]
-    if window:
+    if offset:
+        x, y = offset
         new_rects = []
         for rect in rects:
             dx = rect[2] / 2
@@ -128,6 +1302,142 @@ def segment_intensity(image, window=None):
         rects = new_rects
     return rects
 
+
+def _map_windows(image, windows, pad, preprocess, segment, processes):
+    """Preprocess and segment many windows of an image.
+
+    When the windows cover most of the region that holds them, that region
+    is preprocessed once and shared; otherwise each window is preprocessed
+    on its own crop.  Crops are padded by `pad` pixels, so both give the
+    same values inside the windows.  The windows are segmented in a thread
+    pool: OpenCV and NumPy release the GIL, so threads run in parallel
+    while sharing the images without copies.
+
+    Parameters
+    ----------
+    pad : int or None
+        Context around each window that `preprocess` needs.  With None,
+        each window is preprocessed on its own unpadded crop, so that the
+        image borders are handled as in a call on the window alone.
+    preprocess : callable
+        Called with a view of the image, returns the inputs of `segment`.
+    segment : callable
+        Called with a window, the offset of the preprocessed view and the
+        inputs, returns the result of that window.
+
+    """
+    height, width = image.shape[:2]
+    bounds = (0, 0, width, height)
+    windows = [_clip_rect([int(v) for v in window], bounds)
+               for window in windows]
+    margin = pad or 0
+    padded = [_clip_rect((x - margin, y - margin,
+                          w + 2 * margin, h + 2 * margin), bounds)
+              for x, y, w, h in windows]
+    x0 = min(x for x, y, w, h in padded)
+    y0 = min(y for x, y, w, h in padded)
+    x1 = max(x + w for x, y, w, h in padded)
+    y1 = max(y + h for x, y, w, h in padded)
+
+    if pad is not None and \
+            (x1 - x0) * (y1 - y0) <= sum(w * h for x, y, w, h in padded):
+        shared = preprocess(image[y0:y1, x0:x1])
+
+        def run(index):
+            return segment(windows[index], (x0, y0), shared)
+    else:
+        def run(index):
+            x, y, w, h = padded[index]
+            return segment(windows[index], (x, y),
+                           preprocess(image[y:y + h, x:x + w]))
+
+    if processes == 1 or len(windows) < 2:
+        return map(run, range(len(windows)))
+    pool = ThreadPool(processes)
+    try:
+        return pool.map(run, range(len(windows)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def segment_windows(image, windows, threshold=12, variance_threshold=None,
+                    size_filter=True, processes=None):
+    """Segment many windows of an image with `segment_edges` in one call.
+
+    The grayscale conversion, blur, gradient magnitude and, with
+    `variance_threshold`, the summed-area tables are shared by overlapping
+    windows, and the windows are segmented in parallel.
+
+    Parameters
+    ----------
+    windows : list of (x, y, w, h)
+        Subwindows in image.
+    processes : int
+        Number of threads.  Defaults to the number of CPUs.
+
+    Returns
+    -------
+    results : list of (rects, display)
+        Result of each window, as returned by `segment_edges`.  Edges along
+        the window borders are computed from the surrounding image, so they
+        can differ slightly from a `segment_edges` call on the window.
+
+    """
+    if not len(windows):
+        return []
+
+    def preprocess(region):
+        gray, mag = edge_magnitude(region)
+        tables = None
+        if variance_threshold:
+            tables = cv2.integral2(gray, sdepth=cv2.CV_64F)
+        return gray, mag, tables
+
+    def segment(window, (x0, y0), (gray, mag, tables)):
+        x, y, w, h = window
+        x, y = x - x0, y - y0
+        mag2 = threshold_magnitude(mag[y:y + h, x:x + w], threshold)
+        contours, hierarchy = find_contours(mag2)
+        rects = process_contours(mag2, contours, hierarchy,
+                                 size_filter=size_filter)
+        if variance_threshold and rects:
+            shifted = [(r[0] + x, r[1] + y, r[2], r[3]) for r in rects]
+            variance = box_statistics(gray, shifted, tables=tables)
+            rects = [rect for rect, keep in
+                     zip(rects, variance['variance'] > variance_threshold)
+                     if keep]
+        return ([(r[0] + x + x0, r[1] + y + y0, r[2], r[3]) for r in rects],
+                mag2)
+
+    return _map_windows(image, windows, 2, preprocess, segment, processes)
+
+
+def segment_intensity_windows(image, windows, processes=None):
+    """Segment many windows of an image with `segment_intensity`.
+
+    The windows are segmented in parallel.  The large blur reaches well
+    past a window, so each window is blurred on its own crop, as
+    `segment_intensity` does, rather than sharing the blur of overlapping
+    windows; the rects are then exactly those of a call on each window.
+
+    Returns
+    -------
+    results : list of lists
+        Rects of each window.
+
+    """
+    if not len(windows):
+        return []
+
+    def segment(window, (x0, y0), threshold):
+        x, y, w, h = window
+        return _intensity_rects(
+            threshold[y - y0:y - y0 + h, x - x0:x - x0 + w], (x, y))
+
+    return _map_windows(image, windows, None, _dark_regions, segment,
+                        processes)
+
 if __name__ == "__main__":
     image = cv2.imread("../data/Plecoptera_Accession_Drawer_4.jpg")
     scaled = 0.5
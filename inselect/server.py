@@ -0,0 +1,248 @@
+"""Inselect segmentation service.
+
+Serves `segment_edges` over HTTP on the local machine, so that other
+tools can get the boxes of an image without starting Python each time.
+
+    POST /segment          Image file as the request body.
+    GET  /segment?path=P   Image at path P on the server's file system.
+    GET  /metrics          Request counts and timings.
+
+Both forms of /segment take optional `threshold`, `variance_threshold`
+and `size_filter` query parameters, and answer with JSON holding the
+image `width` and `height` and its boxes as `rects` of [x, y, w, h].
+
+Uploads larger than `--max_upload` are answered with 413, and uploads
+that arrive while the server is busy with 503, before their body is
+read.
+
+Usage:
+    server.py [--host=<host> --port=<port> --jobs=<n> --queue=<n>
+               --max_upload=<mb>]
+
+Options:
+  -h --help          Show this screen.
+  --host=<host>      Address to listen on [default: 127.0.0.1].
+  --port=<port>      Port to listen on [default: 8642].
+  --jobs=<n>         Number of segmentation worker processes [default: 1].
+  --queue=<n>        Requests that may wait for a worker before new ones
+                     are turned away [default: 8].
+  --max_upload=<mb>  Largest image upload accepted, in megabytes
+                     [default: 64].
+"""
+from __future__ import print_function, division
+
+import json
+import threading
+import time
+import traceback
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+from . import docopt
+from .app import (BATCH_PARAMETERS, _ignore_interrupts, read_image,
+                  segment_image)
+
+
+# Types of the segmentation parameters accepted in queries
+PARAMETERS = {'threshold': int, 'variance_threshold': float,
+              'size_filter': int}
+
+
+def segment_request(path=None, data=None, parameters=None):
+    """Boxes of an image file or of encoded image data, in a worker.
+
+    Returns
+    -------
+    (shape, rects, seconds) : tuple
+        Image height and width, boxes and the time spent segmenting.
+
+    """
+    if path is not None:
+        image = read_image(path)
+    else:
+        image = cv2.imdecode(np.frombuffer(data, np.uint8),
+                             cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError("Cannot decode the uploaded image")
+    start = time.time()
+    rects = segment_image(image, parameters=parameters)
+    return image.shape[:2], rects, time.time() - start
+
+
+class Metrics(object):
+    """Counts and timings of the requests handled, safe across threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = dict(requests=0, succeeded=0, failed=0, rejected=0,
+                           in_flight=0)
+        self.seconds = dict(total=0.0, segmenting=0.0)
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counts[key] += value
+
+    def time(self, total, segmenting):
+        with self.lock:
+            self.seconds['total'] += total
+            self.seconds['segmenting'] += segmenting
+
+    def report(self, workers, capacity):
+        with self.lock:
+            done = max(self.counts['succeeded'], 1)
+            return dict(self.counts,
+                        workers=workers,
+                        capacity=capacity,
+                        uptime=time.time() - self.started,
+                        mean_seconds=self.seconds['total'] / done,
+                        mean_segment_seconds=self.seconds['segmenting'] /
+                        done)
+
+
+class SegmentationServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handing segmentation to a pool of warm workers.
+
+    At most `jobs` + `queue` requests are accepted at once; further ones
+    are answered with 503 straight away, so that clients back off rather
+    than pile up.  Uploads of more than `max_upload` bytes are refused.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address, jobs=1, queue=8, max_upload=64 * 2 ** 20):
+        HTTPServer.__init__(self, address, SegmentationHandler)
+        self.jobs = jobs
+        self.capacity = jobs + queue
+        self.max_upload = max_upload
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.metrics = Metrics()
+        self.pool = Pool(jobs, _ignore_interrupts)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, content, headers=()):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/metrics':
+            self.send_json(200, self.server.metrics.report(
+                self.server.jobs, self.server.capacity))
+        elif url.path == '/segment':
+            if 'path' not in query:
+                self.send_json(400, {'error': "Missing 'path' parameter"})
+            else:
+                self.segment(query, path=query['path'][0])
+        else:
+            self.send_json(404, {'error': "Not found"})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/segment':
+            self.send_json(404, {'error': "Not found"})
+            return
+        # The body is only read once the upload is known to be accepted,
+        # so refused uploads cost no memory
+        self.close_connection = 1
+        try:
+            length = int(self.headers.getheader('Content-Length'))
+            if length < 0:
+                raise ValueError(length)
+        except (TypeError, ValueError):
+            self.server.metrics.add(requests=1, failed=1)
+            self.send_json(411, {'error': "Missing or invalid "
+                                          "'Content-Length'"})
+            return
+        if length > self.server.max_upload:
+            self.server.metrics.add(requests=1, rejected=1)
+            self.send_json(413, {'error': "Upload larger than %d bytes" %
+                                 self.server.max_upload})
+            return
+        self.segment(urlparse.parse_qs(url.query),
+                     upload=lambda: self.rfile.read(length))
+
+    def segment(self, query, path=None, upload=None):
+        """Segment the image at `path`, or the one returned by `upload`
+        once a worker slot is taken."""
+        server = self.server
+        metrics = server.metrics
+        metrics.add(requests=1)
+        try:
+            parameters = dict(BATCH_PARAMETERS)
+            for name, value in query.items():
+                if name in PARAMETERS:
+                    parameters[name] = PARAMETERS[name](value[0])
+        except ValueError as e:
+            metrics.add(failed=1)
+            self.send_json(400, {'error': str(e)})
+            return
+        if not server.slots.acquire(False):
+            metrics.add(rejected=1)
+            self.send_json(503, {'error': "Server busy"},
+                           [('Retry-After', '1')])
+            return
+
+        start = time.time()
+        metrics.add(in_flight=1)
+        try:
+            data = upload() if upload is not None else None
+            (height, width), rects, seconds = server.pool.apply_async(
+                segment_request, (path, data, parameters)).get()
+        except (IOError, ValueError) as e:
+            metrics.add(failed=1)
+            self.send_json(400, {'error': str(e)})
+        except Exception:
+            metrics.add(failed=1)
+            self.send_json(500, {'error': traceback.format_exc()})
+        else:
+            metrics.add(succeeded=1)
+            metrics.time(time.time() - start, seconds)
+            self.send_json(200, {'width': width, 'height': height,
+                                 'rects': rects, 'seconds': seconds})
+        finally:
+            metrics.add(in_flight=-1)
+            server.slots.release()
+
+
+def serve(host='127.0.0.1', port=8642, jobs=1, queue=8,
+          max_upload=64 * 2 ** 20):
+    """Run the segmentation service until interrupted."""
+    server = SegmentationServer((host, port), jobs, queue, max_upload)
+    print("Serving segmentation on http://%s:%d/" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    arguments = docopt(__doc__, argv=argv)
+    serve(arguments['--host'], int(arguments['--port']),
+          int(arguments['--jobs']), int(arguments['--queue']),
+          int(float(arguments['--max_upload']) * 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Boxes of a whole collection in a single file.
+
+A batch run can write every box to one NumPy ``.npz`` file instead of a
+CSV file per image.  The file holds columns, so a collection loads in one
+read:
+
+``images``
+    Path of each image, relative to the directory the run processed, so
+    that the same image has the same key however that directory is
+    given.
+``parameters``
+    Segmentation parameters of each image, as JSON.
+``image``
+    Index in ``images`` of the image of each box.
+``x``, ``y``, ``w``, ``h``
+    Box coordinates, normalised by the image size as in the CSV files.
+"""
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+def load_boxes(path):
+    """Columns of a box store, as a dict of arrays."""
+    with np.load(path) as data:
+        return dict((name, data[name]) for name in data.files)
+
+
+class BoxStore(object):
+    """Box store being written by a run.
+
+    Boxes already in the file at `path` are kept, except for the images
+    added again, whose boxes are replaced.  Nothing is written until
+    `save`.
+
+    Parameters
+    ----------
+    path : str
+        Store file.
+    root : str
+        Directory that image paths are stored relative to, as in
+        `Manifest`.
+
+    """
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.images = OrderedDict()
+        if os.path.exists(path):
+            columns = load_boxes(path)
+            boxes = np.column_stack([columns[c] for c in 'xywh'])
+            starts = np.searchsorted(columns['image'],
+                                     np.arange(len(columns['images']) + 1))
+            for i, image in enumerate(columns['images']):
+                self.images[image] = (boxes[starts[i]:starts[i + 1]],
+                                      columns['parameters'][i])
+
+    def _key(self, image):
+        return os.path.relpath(image, self.root)
+
+    def __contains__(self, image):
+        return self._key(image) in self.images
+
+    def boxes(self, image):
+        """Normalised (x, y, w, h) boxes of an image, as an (N, 4) array."""
+        return self.images[self._key(image)][0]
+
+    def add(self, image, boxes, parameters=None):
+        """Set the normalised (x, y, w, h) boxes of an image."""
+        boxes = np.asarray(boxes, np.float64).reshape(-1, 4)
+        key = self._key(image)
+        self.images.pop(key, None)
+        self.images[key] = (boxes, json.dumps(parameters, sort_keys=True))
+
+    def save(self):
+        """Write all boxes, replacing the file in one step."""
+        images = list(self.images)
+        boxes = [self.images[image][0] for image in images]
+        columns = np.concatenate(boxes or [np.zeros((0, 4))])
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            np.savez(f,
+                     images=np.array(images),
+                     parameters=np.array([self.images[image][1]
+                                          for image in images]),
+                     image=np.repeat(np.arange(len(images), dtype=np.int32),
+                                     [len(b) for b in boxes]),
+                     x=columns[:, 0], y=columns[:, 1],
+                     w=columns[:, 2], h=columns[:, 3])
+        os.rename(temporary, self.path)
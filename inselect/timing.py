@@ -0,0 +1,80 @@
+"""Opt-in timing of the segmentation pipeline stages.
+
+Pipeline functions take an optional `timer` and run each stage through
+`timed`.  Without a timer a stage is simply called, so instrumentation
+costs nothing unless it is asked for.
+"""
+import time
+from collections import OrderedDict
+
+
+class StageTimer(object):
+    """Collects a timing record for every stage that runs.
+
+    Parameters
+    ----------
+    callback : callable
+        Optional function called with each record as it is made, for
+        logging.
+
+    Attributes
+    ----------
+    records : list of dict
+        One record per stage run, with the ``stage`` name, its duration
+        in ``seconds`` and any counts, such as ``contours`` or ``rects``.
+
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+
+    def record(self, stage, seconds, **counts):
+        record = dict(counts, stage=stage, seconds=seconds)
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def totals(self):
+        """Calls, seconds and summed counts of each stage, in run order."""
+        totals = OrderedDict()
+        for record in self.records:
+            total = totals.setdefault(record['stage'],
+                                      {'calls': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            for key, value in record.items():
+                if key != 'stage':
+                    total[key] = total.get(key, 0) + value
+        return totals
+
+    def summary(self):
+        """One line per stage, slowest first."""
+        totals = self.totals()
+        lines = []
+        for stage in sorted(totals, key=lambda s: -totals[s]['seconds']):
+            total = totals[stage]
+            counts = ''.join(' %s=%d' % (key, total[key])
+                             for key in sorted(total)
+                             if key not in ('calls', 'seconds'))
+            lines.append('%-12s %8.3f s %5d calls%s' % (
+                stage, total['seconds'], total['calls'], counts))
+        return '\n'.join(lines)
+
+    def clear(self):
+        del self.records[:]
+
+
+def timed(timer, stage, compute, counts=None):
+    """Run `compute`, recording its duration as `stage` if a timer is given.
+
+    `counts`, if given, is called with the result and returns a dict of
+    counts to add to the record.
+
+    """
+    if timer is None:
+        return compute()
+    start = time.time()
+    value = compute()
+    seconds = time.time() - start
+    timer.record(stage, seconds, **(counts(value) if counts else {}))
+    return value